@@ -184,7 +184,7 @@ class GccVec(walkers.Walker):
         cmd_parts = cls.parse_args(args, [1, 2])
         return cls(cmd_parts[0], cmd_parts[1] if len(cmd_parts) == 2 else None)
 
-    def __iter_single(self, init_addr):
+    def __sequence(self, init_addr):
         first_ptr = self.eval_command(init_addr, '$cur')
         # TODO Maybe references as well.
         assert (first_ptr.type.code == gdb.TYPE_CODE_PTR)
@@ -219,14 +219,19 @@ class GccVec(walkers.Walker):
             value_type = self.value_type
         logger.debug('Identified value_type as: {}'.format(value_type))
 
-        yield from walker_defs.Array.single_iter(
-                start=self.format_command(
+        return walker_defs.Array.sequence(
+                start=self.eval_command(
                     init_addr, '({} *)({} + 1)'.format(value_type, vec_str)),
-                count=self.format_command(
+                count=self.eval_command(
                     init_addr, '{}.m_vecpfx.m_num'.format(vec_str)))
 
+    def sequence_def(self, inpipe):
+        if inpipe:
+            return None
+        return self.__sequence(self.calc(self.start_expr))
+
     def iter_def(self, inpipe):
-        yield from self.call_with(inpipe, self.__iter_single, self.start_expr)
+        yield from self.call_with(inpipe, self.__sequence, self.start_expr)
 
 class TreeChain(walkers.Walker):
     '''Walk over TREE nodes in a TREE_CHAIN.
@@ -11,7 +11,7 @@ a small file containing just the line `import neovim_walkers` in the file
 '''
 import itertools as itt
 import gdb
-from helpers import offsetof, eval_uint, uintptr_size, find_type_size
+from helpers import offsetof, eval_uint, uintptr_size
 import walkers
 import walker_defs
 
@@ -434,33 +434,37 @@ class NvimGarray(walkers.Walker):
     '''Walk over all elements of a grow array in (Neo)Vim.
 
     Equivalent to
-        gdb-pipe array <argument2>; <argument1>->ga_data; <argument1>->ga_len
+        gdb-pipe array (<type> *)<growarray>->ga_data; <growarray>->ga_len
 
     Use:
         gdb-pipe nvim-garray <growarray address>; <type>
+        gdb-pipe ... | nvim-garray <type>
 
     Example:
         gdb-pipe nvim-garray &curwin->w_folds; fold_T
     '''
     name = 'nvim-garray'
 
-    def __init__(self, t, start):
+    def __init__(self, t, start_expr):
         self.t = t
-        self.start = start
+        self.start_expr = start_expr
 
     @classmethod
     def from_userstring(cls, args, first, last):
         cmd_parts = cls.parse_args(args, [2, 2] if first else [1, 1])
-        return cls(cmd_parts[-1],
-                   eval_uint(cmd_parts[0]) if first else None)
+        return cls(cmd_parts[-1], cmd_parts[0] if first else '$cur')
+
+    def sequence(self, arg):
+        gar_ptr = '((garray_T *){:#x})'.format(int(arg))
+        return walker_defs.Array.sequence(
+            start=gdb.parse_and_eval(
+                '({} *){}->ga_data'.format(self.t, gar_ptr)),
+            count=gdb.parse_and_eval('{}->ga_len'.format(gar_ptr)))
 
-    def iter_helper(self, arg):
-        gar_ptr = '((garray_T *){})'.format(arg)
-        yield from walker_defs.Array.single_iter(
-            start=eval_uint('{}->ga_data'.format(gar_ptr)),
-            count=eval_uint('{}->ga_len'.format(gar_ptr)),
-            typename=self.t,
-            element_size=find_type_size(self.t))
+    def sequence_def(self, inpipe):
+        if inpipe:
+            return None
+        return self.sequence(self.calc(self.start_expr))
 
     def iter_def(self, inpipe):
-        yield from self.call_with(self.start, inpipe, self.iter_helper)
+        yield from self.call_with(inpipe, self.sequence, self.start_expr)
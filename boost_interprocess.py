@@ -69,36 +69,36 @@ class InterprocessVector(walkers.Walker):
         vector you are inspecting.
 
     Usage:
-        interprocess-vector &v | show print *{}
-        eval &v | interprocess-vector | show print *{}
-        eval 0x7ffeb | eval (boost::interprocess::vector<...>*){.v} |
-            interprocess-vector | show print *{}
+        interprocess-vector &v | show print *$cur
+        eval &v | interprocess-vector | show print *$cur
+        eval 0x7ffeb | eval (boost::interprocess::vector<...>*)$cur |
+            interprocess-vector | show print *$cur
 
     '''
     name = 'interprocess-vector'
     tags = ['data', 'boost::interprocess']
 
-    def __init__(self, start_ele):
-        self.start_ele = start_ele
+    def __init__(self, start_expr):
+        self.start_expr = start_expr
 
     @classmethod
     def from_userstring(cls, args, first, last):
-        return cls(cls.calc(args.strip()) if first else None)
+        return cls(args.strip() if first else '$cur')
 
-    def __iter_helper(self, ele):
-        element = gdb.parse_and_eval(str(ele))
+    def __sequence(self, element):
         element_type = element.type.target().template_argument(0)
         start_ptr = raw_ptr_from_offsetptr(element['m_holder']['m_start'])
-        num_elements = int(element['m_holder']['m_size'])
-        yield from walker_defs.Array.single_iter(
-            True,
-            start_ptr,
-            num_elements,
-            element_type.name + '*',
-            element_type.sizeof)
+        num_elements = element['m_holder']['m_size']
+        return walker_defs.Array.sequence(
+            gdb.Value(start_ptr).cast(element_type.pointer()), num_elements)
+
+    def sequence_def(self, inpipe):
+        if inpipe:
+            return None
+        return self.__sequence(self.calc(self.start_expr))
 
     def iter_def(self, inpipe):
-        yield from self.call_with(self.start_ele, inpipe, self.__iter_helper)
+        yield from self.call_with(inpipe, self.__sequence, self.start_expr)
 
 
 Raw_ptr_from_Offsetptr()
@@ -0,0 +1,165 @@
+'''
+Static index of which functions call which.
+
+`called-functions` needs the direct `call` targets of every function it
+visits.  Finding these means disassembling the function and parsing the text
+of each instruction, which is slow for large programs and is repeated on
+every query.
+
+The `call-index build` command does this once for all matching functions and
+stores the result in a CallIndex.  The walkers that need call targets ask the
+current index first, and only disassemble functions it doesn't know about.
+
+The index is dropped whenever objfiles are loaded or unloaded.
+
+'''
+import array
+import bisect
+import re
+from collections import defaultdict
+import gdb
+from helpers import (function_disassembly, call_target, search_symbol_wrapper,
+                     as_uintptr, file_func_split)
+
+# The index last built with `call-index build`, or None.
+current = None
+
+
+class CallIndex():
+    '''Caller -> callee adjacency lists in compressed sparse row form.
+
+    `functions` is a sorted array of function start addresses.
+    The call targets of functions[i] are
+        targets[target_starts[i]:target_starts[i+1]]
+    `names` and `filenames` hold the name and source file of each function
+    (the filename is None for functions without debugging information).
+
+    The callee -> caller lists are built in the same form the first time
+    they're asked for, over the sorted array `call_targets` of every address
+    called (including functions outside the index).
+
+    `file_regex` and `func_regex` record which functions the index was built
+    from, so callers needing every caller of a function can tell whether the
+    index has them all.
+
+    '''
+    def __init__(self, entries, file_regex='.*', func_regex='.*'):
+        '''Create an index from (address, name, filename, targets) tuples.'''
+        self.file_regex = file_regex
+        self.func_regex = func_regex
+        entries = sorted(entries, key=lambda entry: entry[0])
+        self.functions = array.array('Q', (entry[0] for entry in entries))
+        self.names = [entry[1] for entry in entries]
+        self.filenames = [entry[2] for entry in entries]
+        self.target_starts = array.array('Q', [0])
+        self.targets = array.array('Q')
+        for entry in entries:
+            self.targets.extend(entry[3])
+            self.target_starts.append(len(self.targets))
+        self.call_targets = None
+        self.caller_starts = None
+        self.callers = None
+
+    def __len__(self):
+        return len(self.functions)
+
+    def covers(self, file_regex):
+        '''Return whether the index has every function in files `file_regex`.'''
+        return self.func_regex == '.*' and self.file_regex in ('.*', file_regex)
+
+    def position(self, addr):
+        '''Return the position of function `addr` in the index, or None.'''
+        pos = bisect.bisect_left(self.functions, addr)
+        if pos < len(self.functions) and self.functions[pos] == addr:
+            return pos
+        return None
+
+    def __contains__(self, addr):
+        return self.position(addr) is not None
+
+    def filename(self, addr):
+        return self.filenames[self.position(addr)]
+
+    def name(self, addr):
+        return self.names[self.position(addr)]
+
+    def callees(self, addr):
+        '''Return the direct call targets of `addr` in instruction order.'''
+        pos = self.position(addr)
+        if pos is None:
+            raise KeyError(addr)
+        return self.targets[self.target_starts[pos]:self.target_starts[pos+1]]
+
+    def __build_callers(self):
+        # Keyed on every call target, not just the functions in the index, so
+        # callers of functions elsewhere (e.g. in libc) can be found too.
+        caller_lists = defaultdict(list)
+        for caller_pos, caller in enumerate(self.functions):
+            start = self.target_starts[caller_pos]
+            end = self.target_starts[caller_pos + 1]
+            # A function calling the same target twice is still one caller.
+            for target in set(self.targets[start:end]):
+                caller_lists[target].append(caller)
+        self.call_targets = array.array('Q', sorted(caller_lists))
+        self.caller_starts = array.array('Q', [0])
+        self.callers = array.array('Q')
+        for callee in self.call_targets:
+            self.callers.extend(caller_lists[callee])
+            self.caller_starts.append(len(self.callers))
+
+    def callers_of(self, addr):
+        '''Return the functions in the index that directly call `addr`.'''
+        if self.callers is None:
+            self.__build_callers()
+        pos = bisect.bisect_left(self.call_targets, addr)
+        if pos == len(self.call_targets) or self.call_targets[pos] != addr:
+            return self.callers[0:0]
+        return self.callers[self.caller_starts[pos]:self.caller_starts[pos+1]]
+
+
+def function_calls(addr, arch, use_fallback):
+    '''Return (filename, call targets) for the function at `addr`.
+
+    If disassembly can't be found, the call targets are None.
+
+    '''
+    func_dis, _, filename = function_disassembly(addr, arch, use_fallback)
+    if not func_dis:
+        return filename, None
+    return filename, [target for target in map(call_target, func_dis)
+                      if target]
+
+
+def build(regexp='.*'):
+    '''Build and return an index of all functions matching `regexp`.
+
+    `regexp` is of the form `file_regex:func_regex` as for `call-graph`.
+    Functions without debugging information are included if `file_regex`
+    matches the empty string.
+
+    '''
+    file_regex, func_regex = file_func_split(regexp)
+    if file_regex is None:
+        file_regex = '.*'
+    use_fallback = re.match(file_regex, '') is not None
+    arch = gdb.current_arch()
+    entries = {}
+    for symbol in search_symbol_wrapper(func_regex, file_regex):
+        addr = int(as_uintptr(symbol.value()))
+        if addr in entries:
+            continue
+        filename, targets = function_calls(addr, arch, use_fallback)
+        if targets is None:
+            continue
+        entries[addr] = (addr, symbol.name, filename, targets)
+    return CallIndex(entries.values(), file_regex, func_regex)
+
+
+def drop_index(_=None):
+    global current
+    current = None
+
+
+gdb.events.new_objfile.connect(drop_index)
+if hasattr(gdb.events, 'clear_objfiles'):
+    gdb.events.clear_objfiles.connect(drop_index)
@@ -9,13 +9,20 @@ The commands defined here are:
 
 '''
 import subprocess as sp
+import json
+import threading
+import signal
+import os
 from collections import defaultdict
 import operator
 import re
+import time
+import struct
 import gdb
+import call_index
 from helpers import (eval_uint, function_disassembly, func_and_offset,
                      file_func_split, as_uintptr, FakeSymbol,
-                     search_symbol_wrapper)
+                     search_symbol_wrapper, disassembly_cache)
 
 
 class ShellPipe(gdb.Command):
@@ -599,6 +606,30 @@ class CallGraphEnabled(gdb.Parameter):
         return curval + ': ' + self.get_set_string()
 
 
+class CallGraphProgress(gdb.Parameter):
+    '''Number of functions above which `call-graph` reports progress.
+
+    When `call-graph init` or `call-graph update +` trace at least this many
+    functions, progress and the time taken by each phase are printed.
+    0 means never report progress.
+
+    '''
+    def __init__(self):
+        super(CallGraphProgress, self).__init__('call-graph-progress',
+                                                gdb.COMMAND_NONE,
+                                                gdb.PARAM_ZUINTEGER)
+        self.value = 500
+
+    def get_set_string(self):
+        return self.get_show_string(self.value)
+
+    def get_show_string(self, curval):
+        if not int(curval):
+            return 'call-graph does not report progress'
+        return 'call-graph reports progress when tracing {} or more '\
+            'functions'.format(curval)
+
+
 class CallGraphOutput(gdb.Parameter):
     '''File call-graph should write to or 'stdout'.
 
@@ -617,25 +648,120 @@ class CallGraphOutput(gdb.Parameter):
         # Default
         self.value = 'stdout'
 
-    def redirect_output(self):
-        old_file = CallGraph.output_file
-        if self.value == 'stdout':
-            CallGraph.output_file = sys.stdout
-        else:
-            new_file = open(self.value, 'a')
-            CallGraph.output_file = new_file
-
-        if old_file != sys.stdout:
-            old_file.close()
-
     def get_set_string(self):
-        self.redirect_output()
+        CallGraph.open_output(self.value, CallGraph.mode)
         return 'call-graph trace output directed to {}'.format(self.value)
 
     def get_show_string(self, curval):
         return self.get_set_string()
 
 
+class CallGraphMode(gdb.Parameter):
+    '''Format call-graph writes its trace in.
+
+    text   => an indented line for each function entry and exit.
+    binary => fixed size records of (timestamp, thread, address, entry/exit)
+              collected in memory and written in blocks.  This is much
+              cheaper for hot functions.  Requires `call-graph-output` to be
+              a file.  Use `call-graph render` to view the log.
+    stats  => nothing is written, instead the number of calls, time spent,
+              and a histogram of call latencies is kept for each function.
+              Use `info call-graph stats` to view them.
+
+    '''
+    modes = ['text', 'binary', 'stats']
+
+    def __init__(self):
+        super(CallGraphMode, self).__init__(
+            'call-graph-mode', gdb.COMMAND_NONE, gdb.PARAM_ENUM, self.modes)
+        self.value = 'text'
+
+    def get_set_string(self):
+        try:
+            CallGraph.open_output(CallGraph.output_name, self.value)
+        except ValueError:
+            self.value = CallGraph.mode
+            raise
+        return self.get_show_string(self.value)
+
+    def get_show_string(self, curval):
+        return 'call-graph writes its trace in {} format'.format(curval)
+
+
+class BinaryTraceLog():
+    '''Buffer of call-graph trace records, written to a file in blocks.
+
+    Each record is four little-endian unsigned 64 bit integers:
+        (timestamp in nanoseconds, thread number, address, kind)
+    where `address` is the address of the breakpoint that was hit and `kind`
+    is `ENTRY` or `EXIT`.
+
+    '''
+    record = struct.Struct('<QQQQ')
+    ENTRY = 0
+    EXIT = 1
+
+    def __init__(self, output_file, records=1 << 15):
+        self.output_file = output_file
+        self.buffer = bytearray(self.record.size * records)
+        self.position = 0
+
+    def add(self, address, kind):
+        thread = gdb.selected_thread()
+        self.record.pack_into(self.buffer, self.position, time.monotonic_ns(),
+                              thread.global_num if thread else 0,
+                              address, kind)
+        self.position += self.record.size
+        if self.position == len(self.buffer):
+            self.flush()
+
+    def flush(self, _=None):
+        if self.position:
+            self.output_file.write(memoryview(self.buffer)[:self.position])
+            self.position = 0
+        self.output_file.flush()
+
+    def close(self):
+        self.flush()
+        self.output_file.close()
+
+    @classmethod
+    def read(cls, filename):
+        '''Iterate over the records in `filename`.'''
+        block_size = cls.record.size * (1 << 15)
+        with open(filename, 'rb') as infile:
+            while True:
+                block = infile.read(block_size)
+                if not block:
+                    return
+                if len(block) % cls.record.size:
+                    raise ValueError('{} is not a call-graph binary log'.format(
+                        filename))
+                yield from cls.record.iter_unpack(block)
+
+
+class FunctionStats():
+    '''Call count, time spent, and latency histogram of one function.
+
+    Times are in nanoseconds.  `histogram[i]` counts the calls whose
+    inclusive time `t` satisfied 2**(i-1) <= t < 2**i.
+
+    '''
+    __slots__ = ('count', 'inclusive', 'exclusive', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.inclusive = 0
+        self.exclusive = 0
+        self.histogram = [0] * 64
+
+    def add(self, inclusive, exclusive):
+        self.count += 1
+        self.inclusive += inclusive
+        self.exclusive += exclusive
+        self.histogram[min(inclusive.bit_length(), 63)] += 1
+
+
 class CallGraph(gdb.Command):
     '''Prefix command for call graph tracing commands.
 
@@ -659,6 +785,10 @@ class CallGraph(gdb.Command):
     You can disable and enable the call-graph tracing by setting the parameter
     `set call-graph-enabled [on|off]`.
 
+    Each thread's position in the call graph is tracked separately.  Once
+    the program has more than one thread, each line of output is prefixed
+    with the GDB thread number, e.g. `[2]`.
+
     `call-graph` output may be directed to a file with
     `set call-graph-output [file]`, and back to stdout with
     `set call-graph-output stdout`.
@@ -669,17 +799,173 @@ class CallGraph(gdb.Command):
     By default, call-graph ignores functions in the dynamic libraries (i.e.
     libc etc). This can be configured using `set call-graph-dynlib`.
 
+    For heavily called functions, `set call-graph-mode binary` records each
+    entry and exit in a compact binary log instead of formatting text.
+    The log can be viewed afterwards with `call-graph render`.
+
     '''
     entry_breaks = {}
     ret_breaks = {}
-    indent_level = 0
     output_file = sys.stdout
+    output_name = 'stdout'
+    mode = 'text'
+    binary_log = None
+    # Shadow stack of the traced functions each thread is in, keyed by ptid.
+    # Each stack entry is
+    #   [function address, entry time, time in children, call path node]
+    # (the times and call path are only recorded in stats mode).
+    thread_stacks = defaultdict(list)
+    # Once the program has more than one thread, text output is tagged with
+    # the thread number.  None until the threads are first counted, after
+    # which new_thread events keep it up to date.
+    tag_threads = None
+    function_stats = defaultdict(FunctionStats)
+    # Trie of the call paths seen in stats mode.
+    # Maps function address to a node [calls, exclusive time, children],
+    # where children is a dictionary of the same form.
+    call_paths = {}
 
     @classmethod
     def do_trace(cls, message):
         cls.output_file.write(message)
         cls.output_file.write('\n')
 
+    @classmethod
+    def open_output(cls, name, mode):
+        '''Direct the trace to file `name` (or 'stdout') in format `mode`.'''
+        if mode == 'binary' and name == 'stdout':
+            raise ValueError('call-graph-mode binary needs call-graph-output '
+                             'to be a file')
+        if cls.binary_log is not None:
+            cls.binary_log.close()
+            cls.binary_log = None
+        if cls.output_file != sys.stdout:
+            cls.output_file.close()
+        cls.output_file = sys.stdout
+        if mode == 'binary':
+            cls.binary_log = BinaryTraceLog(open(name, 'ab'))
+        elif name != 'stdout':
+            cls.output_file = open(name, 'a')
+        cls.output_name = name
+        cls.mode = mode
+
+    @classmethod
+    def current_stack(cls):
+        '''Return the current thread and its shadow stack.'''
+        thread = gdb.selected_thread()
+        ptid = thread.ptid if thread else None
+        return thread, cls.thread_stacks[ptid]
+
+    @classmethod
+    def thread_tag(cls, thread):
+        if thread is None:
+            return ''
+        # Look at the inferior's threads rather than those that hit a tracer,
+        # so the first thread is tagged before a second one calls anything.
+        if cls.tag_threads is None:
+            cls.tag_threads = len(thread.inferior.threads()) > 1
+        if not cls.tag_threads:
+            return ''
+        return '[{}]'.format(thread.global_num)
+
+    @classmethod
+    def thread_created(cls, event):
+        if not cls.tag_threads \
+                and len(event.inferior_thread.inferior.threads()) > 1:
+            cls.tag_threads = True
+
+    @classmethod
+    def trace_entry(cls, bp):
+        if cls.binary_log is not None:
+            cls.binary_log.add(bp.address, BinaryTraceLog.ENTRY)
+            return
+        thread, stack = cls.current_stack()
+        if cls.mode == 'stats':
+            siblings = stack[-1][3][2] if stack and stack[-1][3] \
+                else cls.call_paths
+            node = siblings.get(bp.address)
+            if node is None:
+                node = siblings[bp.address] = [0, 0, {}]
+            stack.append([bp.address, time.monotonic_ns(), 0, node])
+            return
+        stack.append([bp.address, 0, 0, None])
+        cls.do_trace('{}{} --> {}'.format(cls.thread_tag(thread),
+                                          ' '*(4 * len(stack)), bp.desc))
+
+    @classmethod
+    def trace_exit(cls, bp):
+        if cls.binary_log is not None:
+            cls.binary_log.add(bp.address, BinaryTraceLog.EXIT)
+            return
+        thread, stack = cls.current_stack()
+        if cls.mode == 'stats':
+            cls.record_return(stack, bp.function_address, time.monotonic_ns())
+            return
+        cls.do_trace('{}{} <-- {}'.format(cls.thread_tag(thread),
+                                          ' '*(4 * len(stack)), bp.desc))
+        cls.pop_function(stack, bp.function_address)
+
+    @staticmethod
+    def pop_function(stack, function_address):
+        '''Pop `function_address` and everything it called off `stack`.
+
+        Return the popped entries, innermost first.
+        Returns from functions we never saw the entry of (e.g. when tracing
+        was started part way through) leave the stack alone.
+        Functions left without returning (e.g. with longjmp) are popped when
+        a function further up the stack returns.
+
+        '''
+        if not any(frame[0] == function_address for frame in stack):
+            return []
+        popped = []
+        while not popped or popped[-1][0] != function_address:
+            popped.append(stack.pop())
+        return popped
+
+    @classmethod
+    def record_return(cls, stack, function_address, now):
+        inner_time = 0
+        for address, start, child_time, node in cls.pop_function(
+                stack, function_address):
+            inclusive = now - start
+            child_time += inner_time
+            cls.function_stats[address].add(inclusive, inclusive - child_time)
+            if node is not None:
+                node[0] += 1
+                node[1] += inclusive - child_time
+            inner_time = inclusive
+        if stack:
+            stack[-1][2] += inner_time
+
+    @classmethod
+    def clear_stats(cls):
+        cls.function_stats = defaultdict(FunctionStats)
+        cls.call_paths = {}
+
+    @classmethod
+    def iter_call_paths(cls):
+        '''Yield (addresses from outermost, calls, exclusive time) for each
+        call path recorded in stats mode.'''
+        pending = [((address,), node)
+                   for address, node in cls.call_paths.items()]
+        while pending:
+            path, (calls, exclusive, children) = pending.pop()
+            if calls:
+                yield path, calls, exclusive
+            pending.extend((path + (address,), node)
+                           for address, node in children.items())
+
+    @classmethod
+    def clear_stacks(cls, _=None):
+        cls.thread_stacks = defaultdict(list)
+        cls.tag_threads = None
+
+    @classmethod
+    def flush_trace(cls, _=None):
+        if cls.binary_log is not None:
+            cls.binary_log.flush()
+
     @classmethod
     def clear_previous_breakpoints(cls):
         # Can't iterate over the keys directly because we're modifying the
@@ -689,7 +975,7 @@ class CallGraph(gdb.Command):
         for addr in all_addresses:
             remove_addr_trace(addr)
 
-        cls.indent_level = 0
+        cls.clear_stacks()
 
     def __init__(self):
         super(CallGraph, self).__init__('call-graph', gdb.COMMAND_USER,
@@ -713,18 +999,15 @@ def fn_return_addresses(addr, arch):
             for val in func_dis if val['asm'].startswith('ret') ]
 
 
-def add_tracer(symbol, arch):
-    '''Trace the function defined by symbol.
+def install_tracer(addr, names, returns, should_enable):
+    '''Create the entry and return breakpoints for the function at `addr`.
 
-    `symbol` should have a `value()` method, a `symtab.filename` member (i.e.
-    a symtab member that itself has a filename member), and a `name` member.
+    `names` is (function name, filename), and `returns` is the list
+    `fn_return_addresses()` gives for this function.
 
     '''
-    addr = int(as_uintptr(symbol.value()))
-
     # Use hex just because it's pretty for `info call-graph exact`.
-    entry_loc, *names = ('*{}'.format(hex(addr)),
-                         symbol.name, symbol.symtab.filename)
+    entry_loc = '*{}'.format(hex(addr))
 
     # Avoid duplicate symbols by checking if the address already has a
     # breakpoint  -- very often happens in non-debug symbols where the same
@@ -733,36 +1016,121 @@ def add_tracer(symbol, arch):
     # address.
     # This also means that if the given regexp matches functions already
     # traced, we don't end up with duplicate tracers.
-    should_enable = gdb.parameter('call-graph-enabled')
     if addr not in CallGraph.entry_breaks:
         new_bp = EntryBreak(entry_loc, *names)
         new_bp.enabled = should_enable
         CallGraph.entry_breaks[addr] = new_bp
     if addr not in CallGraph.ret_breaks:
-        new_bps = [
-            ReturnBreak(retloc, retdesc, *names)
-            for retloc, retdesc in fn_return_addresses(addr, arch)]
-        for bp in new_bps:
-            bp.enabled = should_enable
+        new_bps = []
+        # Store the list before filling it so an interrupt part way through
+        # leaves every breakpoint where it can be found and removed.
         CallGraph.ret_breaks[addr] = new_bps
+        for retloc, retdesc in returns:
+            bp = ReturnBreak(retloc, retdesc, *names, addr)
+            bp.enabled = should_enable
+            new_bps.append(bp)
+
+
+def add_tracer(symbol, arch):
+    '''Trace the function defined by symbol.
+
+    `symbol` should have a `value()` method, a `symtab.filename` member (i.e.
+    a symtab member that itself has a filename member), and a `name` member.
+
+    '''
+    addr = int(as_uintptr(symbol.value()))
+    install_tracer(addr, (symbol.name, symbol.symtab.filename),
+                   fn_return_addresses(addr, arch),
+                   gdb.parameter('call-graph-enabled'))
+
+
+class TracerProgress():
+    '''Report how far through each phase of installing tracers we are.
+
+    Only reports anything if there are at least `call-graph-progress`
+    functions to trace.
+
+    '''
+    def __init__(self, total):
+        threshold = gdb.parameter('call-graph-progress')
+        self.active = bool(threshold) and total >= threshold
+        self.total = total
+        self.step = max(total // 10, 1)
+        self.phase = None
+        self.start = None
+
+    def begin(self, phase):
+        self.phase = phase
+        self.start = time.perf_counter()
+
+    def update(self, done):
+        if self.active and done % self.step == 0:
+            print('call-graph: {} {}/{}'.format(self.phase, done, self.total))
+
+    def end(self, description):
+        if self.active:
+            print('call-graph: {} in {:.2f}s'.format(
+                description, time.perf_counter() - self.start))
 
 
 def trace_matching_functions(regexp):
-    'Trace all functions matching `regexp` in the current symbol table.'
+    '''Trace all functions matching `regexp` in the current symbol table.
+
+    This is done in three phases: collecting the matching symbols, finding
+    the return instructions of each function, and creating the breakpoints.
+    If interrupted, all tracers created by this call are removed.
+
+    '''
     file_regex, func_regex = file_func_split(regexp)
     if file_regex is None:
         file_regex = '.*' if gdb.parameter('call-graph-nondebug') else '.+'
 
     arch = gdb.current_arch()
+    collect_start = time.perf_counter()
     # We have to break on address to distinguish symbols with the same name in
     # different files.
     #
     # In order to have nice output, we create a string that describes the
     # function for a human -- though symbols with the same name will have the
     # same output for entry tracepoints.
+    functions = {}
     for symbol in search_symbol_wrapper(func_regex, file_regex,
                                         gdb.parameter('call-graph-dynlibs')):
-        add_tracer(symbol, arch)
+        addr = int(as_uintptr(symbol.value()))
+        if addr not in functions and addr not in CallGraph.entry_breaks:
+            functions[addr] = (symbol.name, symbol.symtab.filename)
+
+    progress = TracerProgress(len(functions))
+    progress.start = collect_start
+    progress.end('collected {} functions'.format(len(functions)))
+
+    progress.begin('disassembling')
+    returns = {}
+    for done, addr in enumerate(functions, start=1):
+        returns[addr] = fn_return_addresses(addr, arch)
+        progress.update(done)
+    progress.end('disassembled {} functions'.format(len(functions)))
+
+    progress.begin('creating tracers')
+    should_enable = gdb.parameter('call-graph-enabled')
+    created = []
+    try:
+        for done, (addr, names) in enumerate(functions.items(), start=1):
+            created.append(addr)
+            install_tracer(addr, names, returns[addr], should_enable)
+            progress.update(done)
+    except BaseException:
+        # The last function may only be partly traced, so don't use
+        # remove_addr_trace() which complains about that.
+        for addr in created:
+            entry_bp = CallGraph.entry_breaks.pop(addr, None)
+            if entry_bp is not None:
+                entry_bp.delete()
+            for bp in CallGraph.ret_breaks.pop(addr, []):
+                bp.delete()
+        raise
+    progress.end('created {} breakpoints'.format(
+        sum(1 + len(returns[addr]) for addr in created)))
 
 
 def remove_addr_trace(del_addr):
@@ -830,10 +1198,10 @@ class EntryBreak(gdb.Breakpoint):
         self.desc = desc
         self.func_name = desc
         self.filename = filename
+        self.address = int(loc.lstrip('*'), 0)
 
     def stop(self):
-        CallGraph.indent_level += 4
-        CallGraph.do_trace('{} --> {}'.format(' '*CallGraph.indent_level, self.desc))
+        CallGraph.trace_entry(self)
         return False
 
 
@@ -845,16 +1213,17 @@ class ReturnBreak(gdb.Breakpoint):
     indentation level from the CallGraph data.
 
     '''
-    def __init__(self, loc, desc, func_name, filename):
+    def __init__(self, loc, desc, func_name, filename, function_address):
         super(ReturnBreak, self).__init__(loc, gdb.BP_BREAKPOINT,
                                           -1, True, False)
         self.desc = desc
         self.func_name = func_name
         self.filename = filename
+        self.address = int(loc.lstrip('*'), 0)
+        self.function_address = function_address
 
     def stop(self):
-        CallGraph.do_trace('{} <-- {}'.format(' '*CallGraph.indent_level, self.desc))
-        CallGraph.indent_level -= 4
+        CallGraph.trace_exit(self)
         return False
 
 
@@ -966,6 +1335,110 @@ class CallGraphUpdate(gdb.Command):
         remove_matching_tracers(args[1])
 
 
+class CallGraphFlush(gdb.Command):
+    '''Write any buffered binary call-graph records to the output file.
+
+    The buffer is also written whenever it fills up and whenever the inferior
+    stops or exits.
+
+    '''
+    def __init__(self):
+        super(CallGraphFlush, self).__init__('call-graph flush',
+                                             gdb.COMMAND_USER)
+
+    def invoke(self, *_):
+        self.dont_repeat()
+        CallGraph.flush_trace()
+
+
+class CallGraphRender(gdb.Command):
+    '''Print a binary call-graph log as text.
+
+    Usage:
+        call-graph render LOGFILE [text | folded]
+
+    `text` (the default) prints the log as `call-graph-mode text` would have
+    printed it while tracing.
+    `folded` prints one line per distinct call stack with the total time (in
+    nanoseconds) spent in the innermost function of that stack, in the format
+    used by flamegraph.pl.
+
+    Records from different threads are followed separately.
+
+    '''
+    def __init__(self):
+        super(CallGraphRender, self).__init__('call-graph render',
+                                              gdb.COMMAND_USER,
+                                              gdb.COMPLETE_FILENAME)
+
+    @staticmethod
+    def describer():
+        '''Return a function giving (name, offset) for an address.'''
+        names = {}
+        def describe(address):
+            if address not in names:
+                name, offset = func_and_offset(address)
+                names[address] = (name or hex(address), offset or 0)
+            return names[address]
+        return describe
+
+    def render_text(self, logfile):
+        describe = self.describer()
+        indent_levels = defaultdict(int)
+        many_threads = len({record[1] for record in
+                            BinaryTraceLog.read(logfile)}) > 1
+        for _, thread, address, kind in BinaryTraceLog.read(logfile):
+            name, offset = describe(address)
+            prefix = '[{}]'.format(thread) if many_threads else ''
+            if kind == BinaryTraceLog.ENTRY:
+                indent_levels[thread] += 4
+                print('{}{} --> {}'.format(prefix, ' '*indent_levels[thread],
+                                           name))
+            else:
+                print('{}{} <-- {}+{}'.format(
+                    prefix, ' '*indent_levels[thread], name, offset))
+                indent_levels[thread] -= 4
+
+    def render_folded(self, logfile):
+        describe = self.describer()
+        # Each stack entry is [name, start time, time spent in children].
+        stacks = defaultdict(list)
+        folded = defaultdict(int)
+        for timestamp, thread, address, kind in BinaryTraceLog.read(logfile):
+            name, _ = describe(address)
+            stack = stacks[thread]
+            if kind == BinaryTraceLog.ENTRY:
+                stack.append([name, timestamp, 0])
+                continue
+            # Returns from functions we never saw the entry of (e.g. those
+            # left with longjmp) are ignored.
+            if name not in (frame[0] for frame in stack):
+                continue
+            while True:
+                frame_name, start, child_time = stack.pop()
+                total = timestamp - start
+                key = ';'.join([frame[0] for frame in stack] + [frame_name])
+                folded[key] += total - child_time
+                if stack:
+                    stack[-1][2] += total
+                if frame_name == name:
+                    break
+        for key, value in sorted(folded.items()):
+            print(key, value)
+
+    def invoke(self, arg, _):
+        self.dont_repeat()
+        args = gdb.string_to_argv(arg)
+        if not 1 <= len(args) <= 2 or \
+                (len(args) == 2 and args[1] not in ('text', 'folded')):
+            raise ValueError('Usage: call-graph render LOGFILE [text | folded]')
+        CallGraph.flush_trace()
+        if len(args) == 2 and args[1] == 'folded':
+            self.render_folded(args[0])
+        else:
+            self.render_text(args[0])
+
+
 class CallGraphInfo(gdb.Command):
     '''Print all functions currently traced with call-graph
 
@@ -977,7 +1450,8 @@ class CallGraphInfo(gdb.Command):
     '''
     def __init__(self):
         super(CallGraphInfo, self).__init__('info call-graph',
-                                            gdb.COMMAND_STATUS)
+                                            gdb.COMMAND_STATUS,
+                                            gdb.COMPLETE_NONE, True)
 
     def invoke(self, arg, _):
         args = gdb.string_to_argv(arg)
@@ -996,42 +1470,225 @@ class CallGraphInfo(gdb.Command):
             print('\t', bp.desc)
 
 
+class CallGraphInfoStats(gdb.Command):
+    '''Print the functions that took the most time under `call-graph-mode stats`
+
+    Functions are sorted by total (inclusive) time spent in them, and the
+    first N are shown (default 10).
+    For each function the number of calls, inclusive and exclusive time, and
+    a histogram of call latencies (in power of two buckets) is printed.
+
+    Usage:
+        info call-graph stats [N]
+
+    '''
+    def __init__(self):
+        super(CallGraphInfoStats, self).__init__('info call-graph stats',
+                                                 gdb.COMMAND_STATUS)
+
+    @staticmethod
+    def function_name(address):
+        if address in CallGraph.entry_breaks:
+            return CallGraph.entry_breaks[address].desc
+        name, _ = func_and_offset(address)
+        return name or hex(address)
+
+    @staticmethod
+    def format_time(nanoseconds):
+        for unit, scale in (('s', 10**9), ('ms', 10**6), ('us', 10**3)):
+            if nanoseconds >= scale:
+                return '{:.2f}{}'.format(nanoseconds / scale, unit)
+        return '{}ns'.format(nanoseconds)
+
+    def invoke(self, arg, _):
+        args = gdb.string_to_argv(arg)
+        if len(args) > 1 or (args and not args[0].isdigit()):
+            raise ValueError('Usage: info call-graph stats [N]')
+        limit = int(args[0]) if args else 10
+        ranked = sorted(CallGraph.function_stats.items(),
+                        key=lambda item: item[1].inclusive, reverse=True)
+        print('{:>10} {:>12} {:>12}  {}'.format('calls', 'inclusive',
+                                                 'exclusive', 'function'))
+        for address, stats in ranked[:limit]:
+            print('{:>10} {:>12} {:>12}  {}'.format(
+                stats.count, self.format_time(stats.inclusive),
+                self.format_time(stats.exclusive), self.function_name(address)))
+            print(' '*12 + '  '.join(
+                '<{}:{}'.format(self.format_time(1 << bucket), count)
+                for bucket, count in enumerate(stats.histogram) if count))
+
+
+class CallGraphClearStats(gdb.Command):
+    '''Forget the statistics collected under `call-graph-mode stats`.'''
+    def __init__(self):
+        super(CallGraphClearStats, self).__init__('call-graph clear-stats',
+                                                  gdb.COMMAND_USER)
+
+    def invoke(self, *_):
+        self.dont_repeat()
+        CallGraph.clear_stats()
+
+
+def write_folded(outfile, rows):
+    '''Write (names from outermost, value) rows as folded stacks.
+
+    This is the format used by flamegraph.pl and other flame graph tools.
+
+    '''
+    for names, value in rows:
+        outfile.write(';'.join(name.replace(';', ':') for name in names))
+        outfile.write(' {}\n'.format(value))
+
+
+def write_json(outfile, rows):
+    '''Write an iterable of dictionaries as a JSON list, one at a time.'''
+    outfile.write('[')
+    separator = '\n'
+    for row in rows:
+        outfile.write(separator)
+        outfile.write(json.dumps(row))
+        separator = ',\n'
+    outfile.write('\n]\n')
+
+
+def parse_export_args(command, arg):
+    '''Return the filename and format given to an `export` command.'''
+    args = gdb.string_to_argv(arg)
+    if not 1 <= len(args) <= 2 or \
+            (len(args) == 2 and args[1] not in ('folded', 'json')):
+        raise ValueError('Usage: {} export FILE [folded | json]'.format(command))
+    return os.path.expanduser(args[0]), args[1] if len(args) == 2 else 'folded'
+
+
+class CallGraphExport(gdb.Command):
+    '''Write the statistics collected under `call-graph-mode stats` to FILE.
+
+    Usage:
+        call-graph export FILE [folded | json]
+
+    `folded` (the default) writes one line for each call path seen, with the
+    exclusive time (in nanoseconds) spent in the innermost function of that
+    path, in the format used by flamegraph.pl.
+    `json` writes a list of objects with the keys `stack` (function names,
+    outermost first), `calls`, and `exclusive_ns`.
+
+    '''
+    def __init__(self):
+        super(CallGraphExport, self).__init__('call-graph export',
+                                              gdb.COMMAND_USER,
+                                              gdb.COMPLETE_FILENAME)
+
+    def invoke(self, arg, _):
+        self.dont_repeat()
+        filename, style = parse_export_args('call-graph', arg)
+        name = CallGraphInfoStats.function_name
+        paths = CallGraph.iter_call_paths()
+        with open(filename, 'w') as outfile:
+            if style == 'folded':
+                write_folded(outfile, (
+                    ([name(addr) for addr in path], exclusive)
+                    for path, _, exclusive in paths))
+            else:
+                write_json(outfile, ({'stack': [name(addr) for addr in path],
+                                      'calls': calls,
+                                      'exclusive_ns': exclusive}
+                                     for path, calls, exclusive in paths))
+
+
 class Stack():
     '''Representation of a gdb stack.
 
+    The stack is stored as a tuple of the start address of the function in
+    each frame (or the frame's pc if it has no known function), with the hash
+    computed once.  This makes recording and counting stacks cheap, function
+    names are only looked up when the stack is printed.
+
     '''
-    def __init__(self, sym_list):
-        self.sym_list = sym_list
+    __slots__ = ('addresses', '_hash')
+    # Caches shared by all stacks -- dropped when objfiles change.
+    function_starts = {}
+    names = {}
+
+    def __init__(self, addresses):
+        self.addresses = tuple(addresses)
+        self._hash = hash(self.addresses)
+
+    @classmethod
+    def frame_address(cls, frame):
+        pc = frame.pc()
+        try:
+            return cls.function_starts[pc]
+        except KeyError:
+            pass
+        symbol = frame.function()
+        start = pc if symbol is None else int(as_uintptr(symbol.value()))
+        cls.function_starts[pc] = start
+        return start
+
+    @classmethod
+    def from_current_stack(cls, current_frame=None):
+        current_frame = current_frame or gdb.selected_frame()
+        addresses = []
+        try:
+            while current_frame:
+                addresses.append(cls.frame_address(current_frame))
+                current_frame = current_frame.older()
+        except gdb.error:
+            # Unwinding can fail part way (e.g. in code without frame
+            # information), the frames found so far are still useful.
+            pass
+        return cls(addresses)
 
     @classmethod
-    def from_current_stack(cls):
-        current_frame = gdb.selected_frame()
-        function_stack = []
-        while current_frame:
-            function_stack.append(current_frame.function())
-            current_frame = current_frame.older()
-        return cls(function_stack)
-
-    def _internal_hash(self):
-        # Hash based on addresses of the functions
-        # in the stack.
-        return tuple(
-            int(helpers.as_uintptr(symbol.value()))
-            for symbol in self.sym_list)
+    def describe(cls, addr):
+        name, _ = func_and_offset(addr)
+        return hex(addr) if name is None else name
+
+    @classmethod
+    def address_name(cls, addr):
+        try:
+            return cls.names[addr]
+        except KeyError:
+            name = cls.names[addr] = cls.describe(addr)
+            return name
+
+    @classmethod
+    def clear_caches(cls, _=None):
+        cls.function_starts.clear()
+        cls.names.clear()
 
     def __eq__(self, other):
-        # NOTE
-        #   We might be able to speed this function up by short-circuiting the
-        #   evaluation (i.e. iterate over each value in each objects sym_list,
-        #   checking if the address of each pair of symbols is equal, returning
-        #   False on the first that isn't).
-        return self._internal_hash() == other._internal_hash()
+        return type(self) is type(other) and self.addresses == other.addresses
+
+    def __hash__(self):
+        return self._hash
 
     def __str__(self):
-        return '\n'.join(sym.name for sym in self.sym_list)
+        return '\n'.join(self.address_name(addr) for addr in self.addresses)
 
-    def __hash__(self):
-        return self._internal_hash().__hash__()
+
+class PcStack(Stack):
+    '''A stack recorded as the program counter of each frame.
+
+    Unlike `Stack`, different positions in the same function are counted
+    separately.
+
+    '''
+    __slots__ = ()
+    names = {}
+
+    @classmethod
+    def frame_address(cls, frame):
+        return frame.pc()
+
+    @classmethod
+    def describe(cls, addr):
+        name, offset = func_and_offset(addr)
+        return hex(addr) if name is None else '{}+{}'.format(name, offset)
+
+    @classmethod
+    def clear_caches(cls, _=None):
+        cls.names.clear()
 
 
 class StackStats(gdb.Command):
@@ -1086,6 +1743,127 @@ class StackStatsRecord(gdb.Command):
         StackStats.add_stack(Stack.from_current_stack())
 
 
+class StackStatsSample(gdb.Command):
+    '''Sample the stacks of all threads of the running program.
+
+    Usage:
+        stack-stats sample INTERVAL [COUNT]
+
+    Lets the program run for INTERVAL seconds, interrupts it, records the
+    stack of every thread, and continues it again.  This is done COUNT times
+    (default 100), or until the program stops for any other reason (exits,
+    hits a breakpoint, receives another signal, or is interrupted with ^C).
+    Stacks are recorded as program counters and are added to the stacks
+    shown by `stack-stats display`.
+
+    This works by sending SIGINT to the inferior process, so only works with
+    native debugging.
+
+    '''
+    def __init__(self):
+        super(StackStatsSample, self).__init__('stack-stats sample',
+                                               gdb.COMMAND_RUNNING)
+
+    @staticmethod
+    def interrupt(pid, sent):
+        sent.set()
+        try:
+            os.kill(pid, signal.SIGINT)
+        except ProcessLookupError:
+            pass
+
+    @staticmethod
+    def stopped_by_sample(stops, sent):
+        '''Return whether the last stop was the SIGINT we sent.'''
+        return (sent.is_set() and stops
+                and isinstance(stops[-1], gdb.SignalEvent)
+                and stops[-1].stop_signal == 'SIGINT')
+
+    @staticmethod
+    def record_all_threads(inferior):
+        original_thread = gdb.selected_thread()
+        try:
+            for thread in inferior.threads():
+                thread.switch()
+                StackStats.add_stack(
+                    PcStack.from_current_stack(gdb.newest_frame()))
+        finally:
+            if original_thread is not None and original_thread.is_valid():
+                original_thread.switch()
+
+    def invoke(self, arg, _):
+        self.dont_repeat()
+        args = gdb.string_to_argv(arg)
+        if not 1 <= len(args) <= 2:
+            raise ValueError('Usage: stack-stats sample INTERVAL [COUNT]')
+        interval = float(args[0])
+        count = int(args[1]) if len(args) == 2 else 100
+        inferior = gdb.selected_inferior()
+        if not inferior.pid:
+            raise ValueError('The program is not being run.')
+
+        stops = []
+        record_stop = stops.append
+        samples = 0
+        gdb.events.stop.connect(record_stop)
+        try:
+            while samples < count:
+                sent = threading.Event()
+                timer = threading.Timer(interval, self.interrupt,
+                                        [inferior.pid, sent])
+                del stops[:]
+                timer.start()
+                try:
+                    gdb.execute('continue', False, True)
+                finally:
+                    timer.cancel()
+                if not self.stopped_by_sample(stops, sent):
+                    break
+                if not inferior.pid or not inferior.threads():
+                    break
+                self.record_all_threads(inferior)
+                samples += 1
+        except KeyboardInterrupt:
+            pass
+        finally:
+            gdb.events.stop.disconnect(record_stop)
+        print('Recorded {} samples'.format(samples))
+
+
+class StackStatsExport(gdb.Command):
+    '''Write the recorded stacks to FILE.
+
+    Usage:
+        stack-stats export FILE [folded | json]
+
+    `folded` (the default) writes one line per stack with the number of times
+    it was seen, in the format used by flamegraph.pl.
+    `json` writes a list of objects with the keys `stack` (function names,
+    outermost first) and `count`.
+
+    '''
+    def __init__(self):
+        super(StackStatsExport, self).__init__('stack-stats export',
+                                               gdb.COMMAND_USER,
+                                               gdb.COMPLETE_FILENAME)
+
+    def invoke(self, arg, _):
+        self.dont_repeat()
+        filename, style = parse_export_args('stack-stats', arg)
+        def stack_names(stack):
+            return [stack.address_name(addr)
+                    for addr in reversed(stack.addresses)]
+        stacks = StackStats.saved_stacks.items()
+        with open(filename, 'w') as outfile:
+            if style == 'folded':
+                write_folded(outfile, (
+                    (stack_names(stack), count) for stack, count in stacks))
+            else:
+                write_json(outfile, (
+                    {'stack': stack_names(stack), 'count': count}
+                    for stack, count in stacks))
+
+
 class StackStatsDisplay(gdb.Command):
     '''Display the set of recorded stacks.'''
     def __init__(self):
@@ -1113,6 +1891,170 @@ class StackStatsClear(gdb.Command):
         StackStats.clear_stacks()
 
 
+class DisassemblyCacheSize(gdb.Parameter):
+    '''Number of functions whose disassembly is kept in memory.
+
+    Disassembling a function is by far the slowest part of `called-functions`,
+    `global-used`, and `call-graph init`.  The most recently used
+    disassemblies are remembered so that repeated queries don't redo the work.
+
+    0 disables the cache.
+
+    '''
+    def __init__(self):
+        super(DisassemblyCacheSize, self).__init__(
+            'disassembly-cache-size', gdb.COMMAND_NONE, gdb.PARAM_ZUINTEGER)
+        self.value = disassembly_cache.max_entries
+
+    def get_set_string(self):
+        disassembly_cache.resize(self.value)
+        return 'disassembly cache holds up to {} functions'.format(self.value)
+
+    def get_show_string(self, curval):
+        return 'disassembly cache holds up to {} functions'.format(curval)
+
+
+class DisassemblyCacheDirectory(gdb.Parameter):
+    '''Directory to keep disassembly between sessions in, or empty for none.
+
+    When set, disassembly of objfiles with a build-id is saved in this
+    directory when GDB exits, when objfiles are unloaded, and on
+    `disassembly-cache save`.  It is used in later sessions for the same
+    build of the objfile, whatever address it is loaded at.
+
+    '''
+    def __init__(self):
+        super(DisassemblyCacheDirectory, self).__init__(
+            'disassembly-cache-directory', gdb.COMMAND_NONE,
+            gdb.PARAM_OPTIONAL_FILENAME)
+        self.value = ''
+
+    def get_set_string(self):
+        disassembly_cache.directory = self.value or None
+        disassembly_cache.on_disk.clear()
+        return self.get_show_string(self.value)
+
+    def get_show_string(self, curval):
+        if not curval:
+            return 'disassembly is not saved between sessions'
+        return 'disassembly is saved in {}'.format(curval)
+
+
+class DisassemblyCacheCommand(gdb.Command):
+    '''Prefix command for managing the cache of function disassembly.
+
+    See `show disassembly-cache-size` and `show disassembly-cache-directory`.
+
+    '''
+    def __init__(self):
+        super(DisassemblyCacheCommand, self).__init__(
+            'disassembly-cache', gdb.COMMAND_USER, gdb.COMPLETE_COMMAND, True)
+
+
+class DisassemblyCacheClear(gdb.Command):
+    '''Forget all cached disassembly (saved files are left alone).'''
+    def __init__(self):
+        super(DisassemblyCacheClear, self).__init__('disassembly-cache clear',
+                                                    gdb.COMMAND_USER)
+
+    def invoke(self, *_):
+        self.dont_repeat()
+        disassembly_cache.clear()
+
+
+class DisassemblyCacheSave(gdb.Command):
+    '''Write new cached disassembly to `disassembly-cache-directory` now.'''
+    def __init__(self):
+        super(DisassemblyCacheSave, self).__init__('disassembly-cache save',
+                                                   gdb.COMMAND_USER)
+
+    def invoke(self, *_):
+        self.dont_repeat()
+        if not disassembly_cache.directory:
+            raise ValueError('disassembly-cache-directory is not set')
+        disassembly_cache.save()
+
+
+class DisassemblyCacheInfo(gdb.Command):
+    '''Print how many functions are cached and how often the cache was used.'''
+    def __init__(self):
+        super(DisassemblyCacheInfo, self).__init__('info disassembly-cache',
+                                                   gdb.COMMAND_STATUS)
+
+    def invoke(self, *_):
+        stats = disassembly_cache.stats
+        print('Functions cached: {} (limit {})'.format(
+            len(disassembly_cache), disassembly_cache.max_entries))
+        print('Hits: {}, hits from disk: {}, misses: {}'.format(
+            stats['hits'], stats['disk hits'], stats['misses']))
+
+
+class CallIndexCommand(gdb.Command):
+    '''Prefix command for the static index of function calls.
+
+    `called-functions` answers from the index built with `call-index build`
+    for every function the index contains, instead of disassembling those
+    functions again on each query.
+
+    The index is dropped whenever objfiles are loaded or unloaded.
+
+    '''
+    def __init__(self):
+        super(CallIndexCommand, self).__init__(
+            'call-index', gdb.COMMAND_USER, gdb.COMPLETE_COMMAND, True)
+
+
+class CallIndexBuild(gdb.Command):
+    '''Index the direct calls made by all functions matching REGEXP.
+
+    Usage:
+        call-index build [REGEXP]
+
+    The format of REGEXP is `file_regex:func_regex` as for `call-graph`, and
+    defaults to all functions.
+    Functions without debugging information are only included if file_regex
+    matches the empty string.
+
+    '''
+    def __init__(self):
+        super(CallIndexBuild, self).__init__('call-index build',
+                                             gdb.COMMAND_USER)
+
+    def invoke(self, arg, _):
+        self.dont_repeat()
+        args = gdb.string_to_argv(arg)
+        if len(args) > 1:
+            raise ValueError('Usage: call-index build [REGEXP]')
+        call_index.current = call_index.build(args[0] if args else '.*')
+        print('Indexed {} functions making {} direct calls'.format(
+            len(call_index.current), len(call_index.current.targets)))
+
+
+class CallIndexClear(gdb.Command):
+    '''Forget the current call index.'''
+    def __init__(self):
+        super(CallIndexClear, self).__init__('call-index clear',
+                                             gdb.COMMAND_USER)
+
+    def invoke(self, *_):
+        self.dont_repeat()
+        call_index.drop_index()
+
+
+class CallIndexInfo(gdb.Command):
+    '''Print the size of the current call index.'''
+    def __init__(self):
+        super(CallIndexInfo, self).__init__('info call-index',
+                                            gdb.COMMAND_STATUS)
+
+    def invoke(self, *_):
+        if call_index.current is None:
+            print('No call index has been built')
+            return
+        print('Call index: {} functions making {} direct calls'.format(
+            len(call_index.current), len(call_index.current.targets)))
+
+
 AttachMatching()
 ShellPipe()
 GlobalUsed()
@@ -1123,11 +2065,37 @@ CallGraphClear()
 CallGraphInit()
 CallGraphUpdate()
 CallGraphInfo()
+CallGraphInfoStats()
+CallGraphClearStats()
+CallGraphExport()
 CallGraphNonDebug()
 CallGraphDynlibs()
 CallGraphEnabled()
 CallGraphOutput()
+CallGraphProgress()
+CallGraphMode()
+CallGraphFlush()
+CallGraphRender()
+gdb.events.stop.connect(CallGraph.flush_trace)
+gdb.events.exited.connect(CallGraph.flush_trace)
+gdb.events.exited.connect(CallGraph.clear_stacks)
+gdb.events.new_thread.connect(CallGraph.thread_created)
+if hasattr(gdb.events, 'clear_objfiles'):
+    gdb.events.clear_objfiles.connect(Stack.clear_caches)
+    gdb.events.clear_objfiles.connect(PcStack.clear_caches)
 StackStats()
 StackStatsRecord()
+StackStatsSample()
+StackStatsExport()
 StackStatsDisplay()
 StackStatsClear()
+DisassemblyCacheSize()
+DisassemblyCacheDirectory()
+DisassemblyCacheCommand()
+DisassemblyCacheClear()
+DisassemblyCacheSave()
+DisassemblyCacheInfo()
+CallIndexCommand()
+CallIndexBuild()
+CallIndexClear()
+CallIndexInfo()
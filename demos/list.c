@@ -70,3 +70,16 @@ int main(int argc, char *argv[])
     free_list(list_head);
     return 0;
 }
+
+/*
+ * Header pointing at a list of a different type, for testing linked-list on
+ * lists whose `next` member changes type.  Set up from the testsuite.
+ */
+typedef struct list_header {
+    int32_t length;
+    int32_t flags;
+    int64_t padding;
+    struct list *next;
+} list_header_t;
+
+list_header_t list_header;
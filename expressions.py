@@ -0,0 +1,335 @@
+'''
+Compile walker expression templates into direct gdb.Value operations.
+
+Most walkers take a GDB expression using `$cur` as a template, and evaluate
+that template once for every element coming down the pipeline.  Going through
+`gdb.parse_and_eval()` means GDB lexes and parses the same string each time.
+
+This module recognises a few very common shapes of template, e.g.
+    $cur->field.subfield
+    $cur + 8
+    *$cur
+    ((struct node *)$cur)->children[0]
+    $cur->next != 0
+and turns them into a python function that performs the same operations
+directly on the gdb.Value given.  Anything we don't recognise is left to
+`gdb.parse_and_eval()`.
+
+When a walker has read a block of memory in bulk (see
+`helpers.buffered_memory()`), scalars read through `*$cur` and `$cur->field`
+are taken from that block rather than read from the inferior again.
+
+NOTE:
+    The functions created here do *not* set the `$cur` convenience variable.
+    Templates relying on side-effects never match the shapes above (there is
+    no assignment, increment, or function call in them), so this should not
+    be noticeable.
+
+'''
+import re
+import collections
+import gdb
+import helpers
+
+# Toggled by `set walker-compile-expressions`.
+enabled = True
+
+# Counts of how many evaluations were done directly and how many went through
+# gdb.parse_and_eval().  Reported by `gdb-pipe --benchmark`.
+stats = collections.Counter()
+
+_token_re = re.compile(r'''\s*(?:
+      (?P<cur>\$cur\b)
+    | (?P<num>0[xX][0-9a-fA-F]+\b|\d+\b)
+    | (?P<ident>[A-Za-z_]\w*(?:::[A-Za-z_]\w*)*)
+    | (?P<op>->|==|!=|<=|>=|[-+*()\[\].<>!])
+    )''', re.VERBOSE)
+
+_comparisons = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+
+class NotLowerable(Exception):
+    '''Raised when a template (or a given value) can't use the direct path.'''
+    pass
+
+
+def c_integer(text):
+    '''Return the value of the C integer literal `text`.
+
+    A leading 0 means octal, as in C (Python's `int(text, 0)` rejects `010`).
+    Raise NotLowerable for anything else so the GDB parser can have a go.
+
+    '''
+    try:
+        if text[:2] in ('0x', '0X'):
+            return int(text[2:], 16)
+        if len(text) > 1 and text[0] == '0':
+            return int(text[1:], 8)
+        return int(text, 10)
+    except ValueError:
+        raise NotLowerable(text)
+
+
+def tokenize(template):
+    '''Split `template` into (kind, text) pairs.
+
+    Raise NotLowerable if there's anything we don't understand.
+
+    '''
+    tokens = []
+    pos = 0
+    template = template.rstrip()
+    while pos < len(template):
+        match = _token_re.match(template, pos)
+        if not match or match.end() == pos:
+            raise NotLowerable(template)
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        pos = match.end()
+    return tokens
+
+
+def lookup_cast_type(typename):
+    '''Find the gdb.Type described by `typename`.
+
+    Asking GDB to parse a cast of a null pointer handles `struct` keywords,
+    pointers, qualifiers, and typedefs all at once.
+
+    '''
+    try:
+        return gdb.parse_and_eval('({} *)0'.format(typename)).type.target()
+    except gdb.error:
+        raise NotLowerable(typename)
+
+
+__int_type = None
+def as_truth_value(truth):
+    '''Convert a python boolean into the gdb.Value a C comparison gives.'''
+    global __int_type
+    if __int_type is None:
+        __int_type = gdb.lookup_type('int')
+    return gdb.Value(1 if truth else 0).cast(__int_type)
+
+
+def dereference(value):
+    '''Dereference `value`, reading from a walker's memory buffer if possible.
+
+    Raise NotLowerable for anything but a pointer (GDB also allows e.g. `*`
+    on an integer).
+
+    '''
+    value_type = value.type.strip_typedefs()
+    if value_type.code != gdb.TYPE_CODE_PTR:
+        raise NotLowerable('*')
+    if helpers.memory_buffers:
+        target = value_type.target()
+        buffered = helpers.buffered_value(int(value), target)
+        if buffered is not None:
+            return buffered
+    return value.dereference()
+
+
+def buffered_member(pointer, name):
+    '''Return member `name` of the structure `pointer` points to from a
+    walker's memory buffer, or None if it is not buffered.
+
+    Raise NotLowerable for static members, which aren't in the structure.
+
+    '''
+    try:
+        field = pointer.type.strip_typedefs().target().strip_typedefs()[name]
+    except (KeyError, TypeError, gdb.error):
+        return None
+    # gdb.Field has no `bitpos` for static members.
+    if not hasattr(field, 'bitpos'):
+        raise NotLowerable(name)
+    if field.bitsize or field.bitpos % 8:
+        return None
+    return helpers.buffered_value(int(pointer) + field.bitpos // 8,
+                                  field.type)
+
+
+def member(value, name, through_pointer):
+    '''Access member `name` of `value` as GDB would for `->` or `.`'''
+    if value.type.strip_typedefs().code == gdb.TYPE_CODE_PTR:
+        if helpers.memory_buffers:
+            buffered = buffered_member(value, name)
+            if buffered is not None:
+                return buffered
+        value = value.dereference()
+    elif through_pointer:
+        raise NotLowerable(name)
+    return value[name]
+
+
+class Parser():
+    '''Recursive descent parser over the shapes of template we lower.
+
+    Each method returns a python function taking the current element and
+    returning a gdb.Value.
+
+    '''
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self, offset=0):
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset]
+        return (None, None)
+
+    def take(self, text=None):
+        kind, value = self.peek()
+        if kind is None or (text is not None and value != text):
+            raise NotLowerable(text)
+        self.pos += 1
+        return kind, value
+
+    def parse(self):
+        function = self.comparison()
+        if self.pos != len(self.tokens):
+            raise NotLowerable(self.tokens[self.pos:])
+        return function
+
+    def constant(self):
+        negate = self.peek()[1] == '-'
+        if negate:
+            self.take('-')
+        kind, text = self.take()
+        if kind != 'num':
+            raise NotLowerable(text)
+        value = c_integer(text)
+        return -value if negate else value
+
+    def comparison(self):
+        lhs = self.additive()
+        comparison = self.peek()[1]
+        if comparison not in _comparisons:
+            return lhs
+        self.take()
+        rhs = self.constant()
+        compare = _comparisons[comparison]
+        return lambda cur: as_truth_value(compare(lhs(cur), rhs))
+
+    def additive(self):
+        function = self.unary()
+        while self.peek()[1] in ('+', '-'):
+            _, operator = self.take()
+            offset = self.constant()
+            if operator == '-':
+                offset = -offset
+            function = (lambda inner, offset:
+                        lambda cur: inner(cur) + offset)(function, offset)
+        return function
+
+    def is_cast(self):
+        if self.peek()[1] != '(':
+            return False
+        offset = 1
+        seen_ident = False
+        while True:
+            kind, text = self.peek(offset)
+            if kind == 'ident':
+                seen_ident = True
+            elif text == ')':
+                return seen_ident
+            elif text != '*':
+                return False
+            offset += 1
+
+    def unary(self):
+        kind, text = self.peek()
+        if text == '!':
+            self.take()
+            inner = self.unary()
+            return lambda cur: as_truth_value(not inner(cur))
+        if text == '*':
+            self.take()
+            inner = self.unary()
+            return lambda cur: dereference(inner(cur))
+        if self.is_cast():
+            self.take('(')
+            typename = []
+            while self.peek()[1] != ')':
+                typename.append(self.take()[1])
+            self.take(')')
+            cast_type = lookup_cast_type(' '.join(typename))
+            inner = self.unary()
+            return lambda cur: inner(cur).cast(cast_type)
+        return self.postfix()
+
+    def postfix(self):
+        function = self.primary()
+        while True:
+            text = self.peek()[1]
+            if text in ('->', '.'):
+                self.take()
+                kind, name = self.take()
+                if kind != 'ident':
+                    raise NotLowerable(name)
+                function = (lambda inner, name, through_pointer:
+                            lambda cur: member(inner(cur), name,
+                                               through_pointer)
+                            )(function, name, text == '->')
+            elif text == '[':
+                self.take()
+                index = self.constant()
+                self.take(']')
+                function = (lambda inner, index:
+                            lambda cur: inner(cur)[index])(function, index)
+            else:
+                return function
+
+    def primary(self):
+        kind, text = self.take()
+        if kind == 'cur':
+            return lambda cur: cur
+        if text == '(':
+            function = self.comparison()
+            self.take(')')
+            return function
+        raise NotLowerable(text)
+
+
+class CompiledExpression():
+    '''A walker template prepared for repeated evaluation.
+
+    If the template matched one of the shapes we know about, calling this
+    object evaluates it directly on the gdb.Value given.  Otherwise (or if the
+    direct evaluation fails for a given value) it raises NotLowerable and the
+    caller should fall back to gdb.parse_and_eval().
+
+    '''
+    def __init__(self, template):
+        self.template = template
+        try:
+            self.function = Parser(tokenize(template)).parse()
+        except NotLowerable:
+            self.function = None
+
+    @property
+    def lowered(self):
+        return self.function is not None
+
+    def __call__(self, element):
+        if not enabled or self.function is None \
+                or not isinstance(element, gdb.Value):
+            stats['parsed'] += 1
+            raise NotLowerable(self.template)
+        try:
+            retval = self.function(element)
+        except (gdb.error, NotLowerable, TypeError, ValueError, KeyError):
+            # gdb.error includes gdb.MemoryError.
+            # Whatever went wrong, let the fallback path either handle it or
+            # report the problem the usual way.
+            stats['parsed'] += 1
+            raise NotLowerable(self.template)
+        stats['lowered'] += 1
+        return retval
@@ -2,11 +2,15 @@
 
 '''
 import gdb
+import os
 import re
+import pickle
+import tempfile
 import contextlib
 import collections
 import logging
 import itertools as itt
+import bisect
 
 logger = logging.getLogger(__name__)
 
@@ -100,10 +104,82 @@ def start_handler(_):
     gdb.events.new_objfile.disconnect(start_handler)
 
 
+def target_byteorder():
+    '''Return the byte order of the current target as 'little' or 'big'.
+
+    Suitable for passing to int.from_bytes() on the result of
+    gdb.Inferior.read_memory().
+
+    '''
+    endian = gdb.execute('show endian', False, True)
+    return 'big' if 'big endian' in endian else 'little'
+
+
 def offsetof(typename, field):
     return eval_uint('&((({} *)0)->{})'.format(typename, field))
 
 
+# Blocks of inferior memory that a walker has read in bulk (e.g. `array`),
+# stored as [start_address, bytes] pairs.
+# While a block is here, other walkers may read scalar values in that range
+# from the buffer instead of asking GDB to read inferior memory again.
+# Everything is dropped as soon as the inferior could have changed.
+memory_buffers = []
+__scalar_codes = {gdb.TYPE_CODE_INT, gdb.TYPE_CODE_FLT, gdb.TYPE_CODE_PTR,
+                  gdb.TYPE_CODE_ENUM, gdb.TYPE_CODE_BOOL, gdb.TYPE_CODE_CHAR}
+__can_build_values = True
+
+
+@contextlib.contextmanager
+def buffered_memory(start, data):
+    '''Make `data` (read from inferior address `start`) available to
+    `buffered_value()` for the duration of the block.'''
+    if data is None:
+        yield
+        return
+    entry = [start, data]
+    memory_buffers.append(entry)
+    try:
+        yield
+    finally:
+        with contextlib.suppress(ValueError):
+            memory_buffers.remove(entry)
+
+
+def buffered_value(addr, value_type):
+    '''Return the scalar of type `value_type` at `addr` from a memory buffer.
+
+    Return None if `value_type` is not a scalar, if no buffer covers the
+    range, or if this GDB can't create a gdb.Value from a buffer.
+
+    '''
+    global __can_build_values
+    if not __can_build_values or \
+            value_type.strip_typedefs().code not in __scalar_codes:
+        return None
+    size = value_type.sizeof
+    for start, data in reversed(memory_buffers):
+        offset = addr - start
+        if 0 <= offset and offset + size <= len(data):
+            try:
+                return gdb.Value(data[offset:offset + size], value_type)
+            except TypeError:
+                # gdb.Value(buffer, type) was added in GDB 8.3.
+                __can_build_values = False
+                return None
+    return None
+
+
+def drop_memory_buffers(_=None):
+    '''Forget all buffered memory (it may no longer match the inferior).'''
+    memory_buffers.clear()
+
+
+for event_name in ('memory_changed', 'inferior_call', 'cont', 'exited'):
+    if hasattr(gdb.events, event_name):
+        getattr(gdb.events, event_name).connect(drop_memory_buffers)
+
+
 # Update __uintptr_t value on first objfile added because by then we'll know
 # what the current program file architecture is. If we find the current pointer
 # type before we do anything else gdb just guesses.
@@ -405,39 +481,61 @@ else:
         return parse_sources_output(cmd_output).value
 
 
-    def search_symbol_wrapper(regexp, file_regex, include_dynlibs=False):
-        '''Return symbols matching REGEXP defined in files matching FILE_REGEXP
+    class SymbolIndex():
+        '''All function symbols in the program, found once and then reused.
 
-        If FILE_REGEXP matches the empty string, include Non-debug functions.
+        Without `gdb.execute_mi` the only way to find symbols is to parse the
+        output of `info sources` and `info functions`.  This is slow for large
+        programs, so we do it once and keep the results until objfiles are
+        loaded or unloaded.
+
+        `source_files` lists the files with debugging information, and
+        `debug_functions` maps each of those asked about so far to the
+        function symbols it defines (decoding every file up front would be
+        slow when only a few are wanted).
+        `nondebug_functions` is a list of (name, address, in_main_program)
+        tuples for functions without debugging information.
 
         '''
-        include_non_debugging = re.search(file_regex, '') is not None
-        try:
-            cmd_output = gdb.execute('info sources', False, True)
-        except gdb.error as e:
-            if e.args != ('No symbol table is loaded.  Use the "file" command.',):
-                raise e
-            print('Can not find debug symbols:', e.args)
-        else:
+        def __init__(self):
+            self.source_files = None
+            self.debug_functions = {}
+            self.nondebug_functions = None
+
+        def invalidate(self, _=None):
+            self.source_files = None
+            self.debug_functions = {}
+            self.nondebug_functions = None
+
+        def __read_source_files(self):
+            self.source_files = []
+            try:
+                cmd_output = gdb.execute('info sources', False, True)
+            except gdb.error as e:
+                if e.args != ('No symbol table is loaded.  Use the "file" command.',):
+                    raise e
+                print('Can not find debug symbols:', e.args)
+                return
             parsed_output = get_sources_from_output(cmd_output)
-            for filename in set(x for x in 
-                                itt.chain.from_iterable(parsed_output.values())
-                                if re.search(file_regex, x)):
-                yield from file_symbols(filename, regexp)
-
-        if include_non_debugging:
-            # TODO not really sure whether this is a safe way of making sure we
-            # only get the main program. Read the gdb source and see what's
-            # actually happening.
-            cur_progfile = gdb.current_progspace().filename
-
+            self.source_files = sorted(
+                set(itt.chain.from_iterable(parsed_output.values())))
+
+        def functions_in(self, filename):
+            '''Return the function symbols defined in `filename`.'''
+            symbols = self.debug_functions.get(filename)
+            if symbols is None:
+                symbols = list(file_symbols(filename, '.*'))
+                self.debug_functions[filename] = symbols
+            return symbols
+
+        def __read_nondebug_functions(self):
+            self.nondebug_functions = []
+            progspace = gdb.current_progspace()
             # Don't filter functions directly with regexp because we want to
             # use python rexexp (to match the filter done above).
             all_symbols = gdb.execute('info functions', False, True)
             non_debug_start = all_symbols.find('Non-debugging symbols:')
             all_non_debugging = all_symbols[non_debug_start:].splitlines()[1:]
-            # Just because it makes me feel better to let python free the big
-            # string -- probably doesn't matter.
             del all_symbols
             for line in all_non_debugging:
                 # If ValueError() is raised here, then my assumptions are
@@ -457,16 +555,51 @@ else:
                     raise e
 
                 # Assume users don't care about the indirection functions.
-                if not re.match(regexp, name) or name.endswith('@plt'):
+                if name.endswith('@plt'):
+                    continue
+                addr = int(addr, 16)
+                # solib_name() is None for addresses in the main program.
+                self.nondebug_functions.append(
+                    (name, addr, progspace.solib_name(addr) is None))
+
+        def debug_symbols(self, regexp, file_regex):
+            if self.source_files is None:
+                self.__read_source_files()
+            for filename in self.source_files:
+                if re.search(file_regex, filename):
+                    yield from (sym for sym in self.functions_in(filename)
+                                if re.match(regexp, sym.name))
+
+        def nondebug_symbols(self, regexp, include_dynlibs):
+            if self.nondebug_functions is None:
+                self.__read_nondebug_functions()
+            for name, addr, in_main_program in self.nondebug_functions:
+                if not re.match(regexp, name):
+                    continue
+                if not include_dynlibs and not in_main_program:
                     continue
                 logger.debug(f'nondebug symbol search: {name}:{addr}')
-                if not include_dynlibs:
-                    sym_objfile = gdb.execute('info symbol {}'.format(addr),
-                                              False, True).split()[-1]
-                    if sym_objfile != cur_progfile:
-                        continue
+                yield FakeSymbol.from_valueint(name, addr)
 
-                yield FakeSymbol.from_valuestring(name, addr)
+    symbol_index = SymbolIndex()
+    gdb.events.new_objfile.connect(symbol_index.invalidate)
+    for event_name in ('clear_objfiles', 'free_objfile'):
+        if hasattr(gdb.events, event_name):
+            getattr(gdb.events, event_name).connect(symbol_index.invalidate)
+
+    def search_symbol_wrapper(regexp, file_regex, include_dynlibs=False):
+        '''Return symbols matching REGEXP defined in files matching FILE_REGEXP
+
+        If FILE_REGEXP matches the empty string, include Non-debug functions.
+
+        Symbols are taken from `symbol_index`, so the output of `info sources`
+        and `info functions` is only parsed once for each set of objfiles.
+
+        '''
+        include_non_debugging = re.search(file_regex, '') is not None
+        yield from symbol_index.debug_symbols(regexp, file_regex)
+        if include_non_debugging:
+            yield from symbol_index.nondebug_symbols(regexp, include_dynlibs)
 
 
 def get_function_block(addr):
@@ -499,9 +632,308 @@ def enumdesc_from_enumvalue(enumvalue):
     raise ValueError('Given value is not in the valid range of enum type {}'.format(enumvalue.type.name))
 
 
+__integer_codes = {gdb.TYPE_CODE_INT, gdb.TYPE_CODE_PTR, gdb.TYPE_CODE_ENUM,
+                   gdb.TYPE_CODE_BOOL, gdb.TYPE_CODE_CHAR}
+def to_native(value):
+    '''Convert `value` to a python int, float, or str for use as a key.
+
+    Integers, pointers, enums, and characters become an int, floating point
+    values become a float, anything else becomes the string GDB would print.
+    Python values are returned unchanged.
+
+    Native values are much cheaper to compare, hash, and store than
+    gdb.Value objects.
+
+    '''
+    if not isinstance(value, gdb.Value):
+        return value
+    code = value.type.strip_typedefs().code
+    if code in __integer_codes:
+        return int(value)
+    if code == gdb.TYPE_CODE_FLT:
+        return float(value)
+    return str(value)
+
+
+def objfile_key(addr):
+    '''Return the build-id (or filename) of the objfile containing `addr`.
+
+    Return None if no objfile contains `addr`.
+
+    '''
+    progspace = gdb.current_progspace()
+    if hasattr(progspace, 'objfile_for_address'):
+        objfile = progspace.objfile_for_address(addr)
+    else:
+        name = progspace.solib_name(addr) or progspace.filename
+        try:
+            objfile = gdb.lookup_objfile(name) if name else None
+        except ValueError:
+            objfile = None
+    if objfile is None:
+        return None
+    return getattr(objfile, 'build_id', None) or objfile.filename
+
+
+__section_re = re.compile(r'\s*0x([0-9a-f]+) - 0x([0-9a-f]+) is (\S+)')
+__section_ranges = None
+
+
+def read_section_ranges():
+    '''Return the sorted section starts, and (start, end, name) of sections.'''
+    ranges = []
+    for line in gdb.execute('info files', False, True).splitlines():
+        match = __section_re.match(line)
+        if match:
+            ranges.append((int(match.group(1), 16), int(match.group(2), 16),
+                           match.group(3)))
+    ranges.sort()
+    return [start for start, _, _ in ranges], ranges
+
+
+def section_containing(addr):
+    '''Return (name, start address) of the loaded section containing `addr`.
+
+    Sections are read from `info files` once per change of objfiles.
+    Return None if no section contains `addr`.
+
+    '''
+    global __section_ranges
+    def find():
+        starts, ranges = __section_ranges
+        pos = bisect.bisect_right(starts, addr) - 1
+        if pos >= 0 and addr < ranges[pos][1]:
+            return ranges[pos][2], ranges[pos][0]
+        return None
+    fresh = __section_ranges is None
+    if fresh:
+        __section_ranges = read_section_ranges()
+    found = find()
+    if found is None and not fresh:
+        # Sections may have moved without an event telling us (e.g. a
+        # position independent executable relocated when it starts).
+        __section_ranges = read_section_ranges()
+        found = find()
+    return found
+
+
+def drop_section_ranges(_=None):
+    global __section_ranges
+    __section_ranges = None
+
+
+for event_name in ('new_objfile', 'clear_objfiles', 'free_objfile', 'exited'):
+    if hasattr(gdb.events, event_name):
+        getattr(gdb.events, event_name).connect(drop_section_ranges)
+
+
+__symbolic_address_re = re.compile(r'0x([0-9a-f]+)(?= <)')
+
+
+def relocate_disassembly(disassembly, delta):
+    '''Return `disassembly` as it would be with its objfile moved by `delta`.
+
+    Instruction addresses move, as do the addresses GDB shows with a symbol
+    name (e.g. `call 0x1040 <puts@plt>`), which are in the same objfile for
+    the calls and jumps we look at.
+
+    '''
+    if not delta:
+        return disassembly
+    def move(match):
+        return hex(int(match.group(1), 16) + delta)
+    return tuple(dict(instruction, addr=instruction['addr'] + delta,
+                      asm=__symbolic_address_re.sub(move, instruction['asm']))
+                 for instruction in disassembly)
+
+
+class DisassemblyCache():
+    '''Least recently used cache of `function_disassembly()` results.
+
+    Entries are keyed on the objfile build-id and the function address.
+
+    When `directory` is set, entries for objfiles with a build-id are saved to
+    `<directory>/<build-id>.pickle` and loaded back in a later session.
+    On disk, functions are identified by their section and offset into it, so
+    entries are still found when the objfile is loaded at another address
+    (e.g. position independent executables).  Entries loaded from disk are
+    only used if the memory at the function start still holds the same
+    instruction bytes.
+
+    '''
+    file_version = 2
+
+    def __init__(self, max_entries=16384):
+        self.max_entries = max_entries
+        self.directory = None
+        self.entries = collections.OrderedDict()
+        self.on_disk = {}
+        self.unsaved = collections.defaultdict(dict)
+        self.stats = collections.Counter()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+        self.on_disk.clear()
+
+    def resize(self, max_entries):
+        self.max_entries = max_entries
+        while len(self.entries) > max(max_entries, 0):
+            self.entries.popitem(last=False)
+
+    def filename(self, build_id):
+        return os.path.join(self.directory, build_id + '.pickle')
+
+    @staticmethod
+    def persistable(build_id):
+        return build_id is not None and re.match(r'^[0-9a-f]+$', build_id)
+
+    def read_file(self, build_id):
+        try:
+            with open(self.filename(build_id), 'rb') as infile:
+                saved = pickle.load(infile)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return {}
+        if saved.get('version') != self.file_version:
+            return {}
+        return saved['entries']
+
+    @staticmethod
+    def code_bytes(disassembly):
+        first = disassembly[0]
+        return gdb.selected_inferior().read_memory(
+            first['addr'], first['length']).tobytes()
+
+    @staticmethod
+    def disk_key(key):
+        '''Return the key for `key` on disk and the start of its section.'''
+        _, addr, arch_name, use_fallback = key
+        section = section_containing(addr)
+        if section is None:
+            return None, None
+        name, start = section
+        return (name, addr - start, arch_name, use_fallback), start
+
+    def from_disk(self, key):
+        build_id = key[0]
+        if not self.directory or not self.persistable(build_id):
+            return None
+        disk_key, section_start = self.disk_key(key)
+        if disk_key is None:
+            return None
+        if build_id not in self.on_disk:
+            self.on_disk[build_id] = self.read_file(build_id)
+        saved = self.on_disk[build_id].pop(disk_key, None)
+        if saved is None:
+            return None
+        saved_start, check, retval = saved
+        func_dis = relocate_disassembly(retval[0], section_start - saved_start)
+        try:
+            if self.code_bytes(func_dis) != check:
+                return None
+        except gdb.error:
+            return None
+        return (func_dis,) + tuple(retval[1:])
+
+    def lookup(self, key):
+        '''Return the cached value for `key`, or None.'''
+        if self.max_entries <= 0:
+            return None
+        retval = self.entries.get(key)
+        if retval is not None:
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return retval
+        retval = self.from_disk(key)
+        if retval is not None:
+            self.stats['disk hits'] += 1
+            self.insert(key, retval, from_disk=True)
+            return retval
+        self.stats['misses'] += 1
+        return None
+
+    def insert(self, key, value, from_disk=False):
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = value
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        build_id = key[0]
+        # Only remember what to save when there's somewhere to save it.
+        if from_disk or not self.directory or not value[0] \
+                or not self.persistable(build_id):
+            return
+        disk_key, section_start = self.disk_key(key)
+        if disk_key is None:
+            return
+        try:
+            check = self.code_bytes(value[0])
+        except gdb.error:
+            return
+        self.unsaved[build_id][disk_key] = (section_start, check, value)
+
+    def save(self):
+        '''Write all new entries into `directory`.'''
+        if not self.directory:
+            self.unsaved.clear()
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        for build_id, new_entries in self.unsaved.items():
+            entries = self.read_file(build_id)
+            entries.update(new_entries)
+            handle, tmpname = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(handle, 'wb') as outfile:
+                pickle.dump({'version': self.file_version, 'entries': entries},
+                            outfile, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpname, self.filename(build_id))
+        self.unsaved.clear()
+
+
+disassembly_cache = DisassemblyCache()
+
+
+def drop_disassembly_cache(_=None):
+    '''Save and forget cached disassembly -- the objfiles have changed.'''
+    disassembly_cache.save()
+    disassembly_cache.clear()
+
+
+def save_disassembly_cache(_=None):
+    disassembly_cache.save()
+
+
+for event_name in ('clear_objfiles', 'free_objfile'):
+    if hasattr(gdb.events, event_name):
+        getattr(gdb.events, event_name).connect(drop_disassembly_cache)
+if hasattr(gdb.events, 'gdb_exiting'):
+    gdb.events.gdb_exiting.connect(save_disassembly_cache)
+
+
 def function_disassembly(func_addr, arch=None, use_fallback=True):
     '''Return the disassembly and filename of the function at `func_addr`.
 
+    Acts as `__function_disassembly()`, but results are remembered in
+    `disassembly_cache`.
+
+    '''
+    arch = arch or gdb.current_arch()
+    func_addr = int(func_addr)
+    key = (objfile_key(func_addr), func_addr, arch.name(), use_fallback)
+    retval = disassembly_cache.lookup(key)
+    if retval is None:
+        func_dis, function_name, function_filename = __function_disassembly(
+            func_addr, arch, use_fallback)
+        retval = (tuple(func_dis) if func_dis is not None else None,
+                  function_name, function_filename)
+        disassembly_cache.insert(key, retval)
+    return retval
+
+
+def __function_disassembly(func_addr, arch, use_fallback):
+    '''Return the disassembly and filename of the function at `func_addr`.
+
     If there are no debugging symbols, return the None as the filename.
         (function_disassembly, function_name or None, function_filename or None)
 
@@ -513,8 +945,6 @@ def function_disassembly(func_addr, arch=None, use_fallback=True):
     for the current function, return (None, None, None).
 
     '''
-    arch = arch or gdb.current_arch()
-
     try:
         func_block = get_function_block(func_addr)
     except RuntimeError as e:
@@ -590,6 +1020,29 @@ def function_disassembly(func_addr, arch=None, use_fallback=True):
     return arch.disassemble(start_addr, last_pos), function_name, None
 
 
+def call_target(instruction):
+    '''Return the address a direct `call` instruction calls, or None.
+
+    `instruction` is one element of the list `function_disassembly()`
+    returns.
+
+    '''
+    elements = instruction['asm'].split()
+    # Make sure the format for this instruction is
+    # call... addr <func_name>
+    # Ignore those functions with '@' in them (to avoid @plt functions).
+    #   Note this wouldn't actually matter much because the plt stubs don't
+    #   have any `call` instructions in them. It just saves a little on
+    #   time.
+    # Return the address converted to a number.
+    if len(elements) == 3 and elements[0].startswith('call') and \
+            re.match('<[^@]*>', elements[-1]):
+        # Just assume it's always hex -- I can't see any way it isn't, but
+        # this assumption makes me a little uneasy.
+        return int(elements[1], base=16)
+    return None
+
+
 def func_and_offset(addr):
     '''Return the function and offset into that function of `addr`.
 
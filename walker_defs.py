@@ -9,11 +9,17 @@ walkers.register_walker().
 '''
 import os
 import re
+import heapq
+import pickle
+import tempfile
+import collections
 import operator
 import gdb
-from helpers import (eval_uint, function_disassembly, as_voidptr,
-                     file_func_split, find_type_size, search_symbol_wrapper)
+from helpers import (eval_uint, as_voidptr,
+                     file_func_split, find_type_size, search_symbol_wrapper,
+                     buffered_memory, target_byteorder, to_native)
 import walkers
+import call_index
 import itertools as itt
 import sys
 
@@ -151,6 +157,8 @@ class Show(walkers.Walker):
     def iter_def(self, inpipe):
         for element in inpipe:
             command = self.format_command(element, self.command)
+            # Elements already passed on may still be buffered for output.
+            sys.stdout.flush()
             gdb.execute(command, False)
             if not self.is_last:
                 yield element
@@ -178,6 +186,7 @@ class Instruction(walkers.Walker):
     '''
     name = 'instructions'
     tags = ['data']
+    stops_early = True
 
     def __init__(self, start_expr, end_expr, count_expr):
         self.arch = gdb.current_arch()
@@ -207,6 +216,16 @@ class Instruction(walkers.Walker):
 
     def iter_helper(self, start, end, count):
         start, end, count = (int(as_voidptr(x)) for x in (start, end, count))
+        if self.output_limit is not None:
+            # Don't disassemble instructions nobody will look at.
+            if self.output_limit == 0:
+                return
+            # With neither an end nor a count only one instruction is
+            # disassembled, a limit can't make that any smaller.
+            if count:
+                count = min(count, self.output_limit)
+            elif end:
+                count = self.output_limit
         for instruction in self.disass(start, end, count):
             temp = gdb.Value(instruction['addr'])
             yield as_voidptr(temp)
@@ -235,16 +254,39 @@ class If(walkers.Walker):
     require_input = True
     tags = ['general']
 
-    def __init__(self, cmd):
+    def __init__(self, cmd, more_conditions=()):
         self.cmd = cmd
+        self.conditions = [cmd] + list(more_conditions)
 
     @classmethod
     def from_userstring(cls, args, first, last):
         return cls(args)
 
+    def fuse(self, following):
+        if type(following) is not If:
+            return None
+        # Conditions that have to go through GDB's parser anyway are joined
+        # into one expression, those we can evaluate directly are kept apart.
+        conditions = list(self.conditions)
+        for condition in following.conditions:
+            if not (self.compiled_expression(conditions[-1]).lowered or
+                    self.compiled_expression(condition).lowered):
+                conditions[-1] = '({}) && ({})'.format(conditions[-1],
+                                                       condition)
+            else:
+                conditions.append(condition)
+        return [If(conditions[0], conditions[1:])]
+
+    def describe(self):
+        if len(self.conditions) == 1:
+            return 'if {}'.format(self.cmd)
+        return 'if {}'.format(' && '.join(
+            '({})'.format(condition) for condition in self.conditions))
+
     def iter_def(self, inpipe):
         for element in inpipe:
-            if self.eval_command(element):
+            if all(self.eval_command(element, condition)
+                   for condition in self.conditions):
                 yield element
 
 
@@ -334,10 +376,26 @@ class Head(walkers.Walker):
             raise ValueError('`head` walker requires an argument')
         return cls(int(gdb.parse_and_eval(args)))
 
+    def input_limit(self):
+        return self.limit if self.limit >= 0 else None
+
+    def describe(self):
+        return 'head {}'.format(self.limit)
+
+    def sequence_def(self, inpipe):
+        if not isinstance(inpipe, walkers.Sequence):
+            return None
+        return inpipe[:self.limit]
+
     def iter_def(self, inpipe):
         if self.limit < 0:
-            all_elements = list(inpipe)
-            yield from all_elements[:self.limit]
+            # Hold back the last N elements seen, anything before them can be
+            # passed on straight away.
+            held_back = collections.deque()
+            for element in inpipe:
+                held_back.append(element)
+                if len(held_back) > -self.limit:
+                    yield held_back.popleft()
         elif self.limit == 0:
             return
         else:
@@ -353,6 +411,9 @@ class Tail(walkers.Walker):
     Can use `tail -N` to pass all but the N first elements.
     NOTE: The `N` can not use `$cur`.
 
+    When the previous walker knows its length (e.g. `array`), the elements
+    before the tail are never read.
+
     Usage:
         tail <N>
 
@@ -372,6 +433,16 @@ class Tail(walkers.Walker):
             raise ValueError('`head` walker requires an argument')
         return cls(int(gdb.parse_and_eval(args)))
 
+    def describe(self):
+        return 'tail {}'.format(self.limit)
+
+    def sequence_def(self, inpipe):
+        if not isinstance(inpipe, walkers.Sequence):
+            return None
+        if self.limit < 0:
+            return inpipe[-self.limit:]
+        return inpipe[max(0, len(inpipe) - self.limit):]
+
     def iter_def(self, inpipe):
         if self.limit < 0:
             limit = abs(self.limit)
@@ -381,14 +452,8 @@ class Tail(walkers.Walker):
                     break
             yield from inpipe
         elif self.limit > 0:
-            # Could have the constant memory version of having a list of the
-            # number of elements required, and setting each of those values in
-            # turn, wrapping around when reaching the end.
-            # In practice, this is a pain and doesn't change the running time.
-            # I could look into whether the list is implemented as an array
-            # etc, but it doesn't seem worth the trouble at the moment.
-            all_elements = list(inpipe)
-            yield from all_elements[-self.limit:]
+            # Only ever keep the last N elements alive.
+            yield from collections.deque(inpipe, maxlen=self.limit)
         else:
             return
 
@@ -396,28 +461,291 @@ class Tail(walkers.Walker):
 class Count(walkers.Walker):
     '''Count how many elements were in the previous walker.
 
+    When the previous walker knows its length (e.g. `array`), no elements are
+    read.
+
+    Given a sub-pipeline in braces, instead replaces each element with the
+    number of elements that sub-pipeline gives when that element is its input.
+    The sub-pipeline has its own `$cur`, the outer `$cur` is restored after
+    each run.
+
     Usage:
         count
+        count { <sub-pipeline> }
 
     Example:
         gdb-pipe instructions main; main+100 | count
+        // Number of children of each node.
+        gdb-pipe ... | count { linked-list $cur->children; next }
 
     '''
     name = 'count'
     require_input = True
     tags = ['general']
 
+    def __init__(self, sub_pipeline=None):
+        self.sub_pipeline = sub_pipeline
+
     @classmethod
     def from_userstring(cls, args, first, last):
-        return cls()
+        return cls(walkers.SubPipeline(args) if args else None)
+
+    def sequence_def(self, inpipe):
+        if self.sub_pipeline is not None \
+                or not isinstance(inpipe, walkers.Sequence):
+            return None
+        return walkers.Sequence(1, lambda _: gdb.Value(len(inpipe)))
 
     def iter_def(self, inpipe):
+        if self.sub_pipeline is not None:
+            for element in inpipe:
+                yield gdb.Value(self.sub_pipeline.count(element))
+            return
         i = None
         for i, _ in enumerate(inpipe):
             pass
         yield gdb.Value(i + 1 if i is not None else 0)
 
 
+class Exists(walkers.Walker):
+    '''Pass on elements for which a sub-pipeline gives at least one element.
+
+    The sub-pipeline in braces is run with each element as its only input,
+    and stops as soon as it gives anything.  With `!`, elements for which the
+    sub-pipeline gives nothing are passed on instead.
+    The sub-pipeline has its own `$cur`, the outer `$cur` is restored after
+    each run.
+
+    This does the same as
+        if $_output_contains("gdb-pipe ...", "...")
+    without running a GDB command and searching its output.
+
+    Usage:
+        exists [!] { <sub-pipeline> }
+
+    Example:
+        // Functions in tree.c that call free_tree.
+        gdb-pipe defined-functions tree.c:.* | \\
+            exists { called-functions $cur; .*; 1 | if $cur == free_tree }
+
+    '''
+    name = 'exists'
+    require_input = True
+    tags = ['general']
+
+    def __init__(self, sub_pipeline, negate=False):
+        self.sub_pipeline = sub_pipeline
+        self.negate = negate
+
+    @classmethod
+    def from_userstring(cls, args, first, last):
+        args = args.strip() if args else ''
+        negate = args.startswith('!')
+        if negate:
+            args = args[1:]
+        return cls(walkers.SubPipeline(args), negate)
+
+    def iter_def(self, inpipe):
+        for element in inpipe:
+            if self.sub_pipeline.any(element) != self.negate:
+                yield element
+
+
+def native_number(value, walker_name):
+    '''Convert `value` to a python int or float for accumulating.'''
+    number = to_native(value)
+    if isinstance(number, str):
+        raise ValueError('{} needs a numeric expression, not {}'.format(
+            walker_name, value.type))
+    return number
+
+
+def required_expression(args, walker_name):
+    '''Return `args`, raising ValueError if no expression was given.'''
+    if not args or not args.strip():
+        raise ValueError('{} requires an expression'.format(walker_name))
+    return args
+
+
+class Sum(walkers.Walker):
+    '''Sum the expression given over all elements of the previous walker.
+
+    Each value is converted to a python int or float and added up in python,
+    so no convenience variable is needed to hold the running total.
+
+    Usage:
+        sum <expr>
+
+    Example:
+        gdb-pipe follow-until 1; $cur > 100; $cur + 1 | sum $cur
+
+    '''
+    name = 'sum'
+    require_input = True
+    tags = ['general']
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+
+    @classmethod
+    def from_userstring(cls, args, first, last):
+        return cls(required_expression(args, cls.name))
+
+    def iter_def(self, inpipe):
+        yield gdb.Value(sum(native_number(self.eval_command(element),
+                                          self.name)
+                            for element in inpipe))
+
+
+class Stats(walkers.Walker):
+    '''Print the count, sum, mean, minimum and maximum of an expression.
+
+    The expression is evaluated once for each element of the previous walker
+    and accumulated in python.  Nothing is passed on.
+
+    Usage:
+        stats <expr>
+
+    Example:
+        gdb-pipe linked-list list_head; next | stats $cur->datum
+
+    '''
+    name = 'stats'
+    require_input = True
+    tags = ['general']
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+
+    @classmethod
+    def from_userstring(cls, args, first, last):
+        return cls(required_expression(args, cls.name))
+
+    def iter_def(self, inpipe):
+        count, total, minimum, maximum = 0, 0, None, None
+        for element in inpipe:
+            value = native_number(self.eval_command(element), self.name)
+            count += 1
+            total += value
+            if minimum is None or value < minimum:
+                minimum = value
+            if maximum is None or value > maximum:
+                maximum = value
+        print('count: {}'.format(count))
+        if count:
+            print('sum: {}'.format(total))
+            print('mean: {}'.format(total / count))
+            print('min: {}'.format(minimum))
+            print('max: {}'.format(maximum))
+        # Nothing is passed on, but this is still a generator so the input
+        # is only read when the pipeline runs.
+        yield from ()
+
+
+class Histogram(walkers.Walker):
+    '''Print a histogram of an expression in power of two buckets.
+
+    The expression is evaluated once for each element of the previous walker
+    and converted to a python number.  Each line shows a range of values, how
+    many elements fell in it, and a bar scaled to the largest bucket.
+    Negative values are all counted in one bucket.  Nothing is passed on.
+
+    Usage:
+        histogram <expr>
+
+    Example:
+        // Distribution of allocation sizes recorded in some table.
+        gdb-pipe array allocations; num_allocations | histogram $cur->size
+
+    '''
+    name = 'histogram'
+    require_input = True
+    tags = ['general']
+    bar_width = 40
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+
+    @classmethod
+    def from_userstring(cls, args, first, last):
+        return cls(required_expression(args, cls.name))
+
+    @staticmethod
+    def bucket_name(bucket):
+        if bucket < 0:
+            return '< 0'
+        if bucket == 0:
+            return '[0, 1)'
+        return '[{}, {})'.format(1 << (bucket - 1), 1 << bucket)
+
+    def iter_def(self, inpipe):
+        # Bucket b holds values in [2**(b-1), 2**b), bucket 0 holds [0, 1).
+        buckets = collections.Counter()
+        for element in inpipe:
+            value = native_number(self.eval_command(element), self.name)
+            buckets[int(value).bit_length() if value >= 0 else -1] += 1
+        if buckets:
+            largest = max(buckets.values())
+            for bucket in sorted(buckets):
+                count = buckets[bucket]
+                print('{:>24} {:>10} {}'.format(
+                    self.bucket_name(bucket), count,
+                    '#' * max(1, count * self.bar_width // largest)))
+        yield from ()
+
+
+class GroupBy(walkers.Walker):
+    '''Count the elements with each value of a key expression.
+
+    For each element the key expression is evaluated and converted to a
+    python int, float, or string.  If a value expression is given as well, it
+    is summed for each key.  Once the input is exhausted a line is printed
+    for each key, ordered by decreasing count.  Nothing is passed on.
+
+    Use `uniq -c` instead to pass on one element for each key.
+
+    Usage:
+        group-by <key>[; <value>]
+
+    Example:
+        // How many allocations, and how many bytes, for each type tag.
+        gdb-pipe array allocations; num_allocations | \\
+            group-by $cur->tag; $cur->size
+
+    '''
+    name = 'group-by'
+    require_input = True
+    tags = ['general']
+
+    def __init__(self, key, value=None):
+        self.key = key
+        self.value = value
+
+    @classmethod
+    def from_userstring(cls, args, first, last):
+        return cls(*cls.parse_args(args, [1, 2], ';'))
+
+    def iter_def(self, inpipe):
+        counts = collections.Counter()
+        sums = collections.Counter()
+        for element in inpipe:
+            key = to_native(self.eval_command(element, self.key))
+            counts[key] += 1
+            if self.value is not None:
+                sums[key] += native_number(
+                    self.eval_command(element, self.value), self.name)
+        # most_common() keeps keys with equal counts in the order first seen.
+        if self.value is None:
+            print('{:>10}  {}'.format('count', 'key'))
+            for key, count in counts.most_common():
+                print('{:>10}  {}'.format(count, key))
+        else:
+            print('{:>10} {:>14}  {}'.format('count', 'sum', 'key'))
+            for key, count in counts.most_common():
+                print('{:>10} {:>14}  {}'.format(count, sums[key], key))
+        yield from ()
+
+
 # TODO
 # Make some `array-size` command that essentially does
 #    sizeof(array)/sizeof(array_element_type)
@@ -443,9 +771,16 @@ class Array(walkers.Walker):
     Example:
         array argv; argc
 
+    When `start` is a pointer, the memory of the array is read in large
+    blocks, and scalar fields accessed with e.g. `*$cur` or `$cur->field` in
+    later walkers are read from that block instead of from the inferior.
+
     '''
     name = 'array'
     tags = ['data']
+    stops_early = True
+    # Maximum number of bytes read from the inferior at once.
+    read_size = 1 << 20
 
     def __init__(self, start, count):
         self.start_expr = start
@@ -456,15 +791,62 @@ class Array(walkers.Walker):
         start, count = cls.parse_args(args, [2, 2])
         return cls(start, count)
 
-    def __iter_single(self, start, count):
+    @classmethod
+    def __iter_pointers(cls, start, first, stop):
+        original_type = start.type
+        element_size = original_type.strip_typedefs().target().sizeof
+        per_read = max(1, cls.read_size // element_size)
+        inferior = gdb.selected_inferior()
+        base = int(start)
+        for first_index in range(first, stop, per_read):
+            read_start = base + first_index * element_size
+            read_end = read_start + min(per_read, stop - first_index) * element_size
+            try:
+                data = inferior.read_memory(read_start, read_end - read_start)
+            except gdb.MemoryError:
+                # Only a speculative read -- we don't need the memory to
+                # provide the pointers.
+                data = None
+            with buffered_memory(read_start, data):
+                for addr in range(read_start, read_end, element_size):
+                    yield gdb.Value(addr).cast(original_type)
+
+    @classmethod
+    def sequence(cls, start, count):
+        '''Return a walkers.Sequence over `count` elements from `start`.
+
+        `start` and `count` are gdb.Values.  Other walkers over contiguous
+        arrays can use this to provide their own Sequence.
+
+        '''
+        count = int(count)
         original_type = start.type
-        cur_value = start
-        for _ in range(count):
-            yield cur_value
-            cur_value = (cur_value + 1).cast(original_type)
+        pointer_type = start.type.strip_typedefs()
+        if pointer_type.code == gdb.TYPE_CODE_PTR \
+                and pointer_type.target().sizeof > 0:
+            element_size = pointer_type.target().sizeof
+            base = int(start)
+            return walkers.Sequence(
+                count,
+                lambda index: gdb.Value(base + index * element_size).cast(
+                    original_type),
+                lambda first, stop: cls.__iter_pointers(start, first, stop))
+        return walkers.Sequence(
+            count, lambda index: (start + index).cast(original_type))
+
+    def limited_sequence(self, start, count):
+        if self.output_limit is not None:
+            count = min(int(count), self.output_limit)
+        return self.sequence(start, count)
+
+    def sequence_def(self, inpipe):
+        if inpipe:
+            return None
+        return self.limited_sequence(self.calc(self.start_expr),
+                                     self.calc(self.count_expr))
 
     def iter_def(self, inpipe):
-        yield from self.call_with(inpipe, self.__iter_single,
+        yield from self.call_with(inpipe, self.limited_sequence,
                                   self.start_expr, self.count_expr)
 
 
@@ -478,6 +860,8 @@ class Max(walkers.Walker):
 
     If more than one element give the same maximum value, then the first is
     returned.
+    Only one element is held at a time, use `top` or `bottom` to find more
+    than one.
 
     Use:
         gdb-pipe ... | max $cur
@@ -500,15 +884,14 @@ class Max(walkers.Walker):
         return cls(args)
 
     def iter_def(self, inpipe):
-        try:
-            _, retelement = max(
-                ((self.eval_command(element), element) for element in inpipe),
-                key=operator.itemgetter(0)
-            )
+        # Only the best element so far is kept alive, and each key is
+        # converted to a python value once so comparisons don't go through
+        # GDB.
+        retelement = max(inpipe, default=None,
+                         key=lambda element: to_native(
+                             self.eval_command(element)))
+        if retelement is not None:
             yield retelement
-        except ValueError as e:
-            if e.args != ('max() arg is an empty sequence',):
-                raise
 
 
 class Min(walkers.Walker):
@@ -519,6 +902,8 @@ class Min(walkers.Walker):
 
     If more than one element give the same minimum value, then the first is
     returned.
+    Only one element is held at a time, use `top` or `bottom` to find more
+    than one.
 
     Use:
         gdb-pipe ... | min $cur
@@ -541,15 +926,77 @@ class Min(walkers.Walker):
         return cls(args)
 
     def iter_def(self, inpipe):
-        try:
-            _, retelement = min(
-                ((self.eval_command(element), element) for element in inpipe),
-                key=operator.itemgetter(0)
-            )
+        # Only the best element so far is kept alive, and each key is
+        # converted to a python value once so comparisons don't go through
+        # GDB.
+        retelement = min(inpipe, default=None,
+                         key=lambda element: to_native(
+                             self.eval_command(element)))
+        if retelement is not None:
             yield retelement
-        except ValueError as e:
-            if e.args != ('min() arg is an empty sequence',):
-                raise
+
+
+class Top(walkers.Walker):
+    '''Pass through the `N` elements with the largest value of an expression.
+
+    Elements come out largest first, which is what `sort -r ... | head N`
+    would give, but only the best `N` elements seen so far are held in memory.
+    As with `sort`, each key is converted to a python int, float, or string
+    and more than one expression may be given to break ties.
+    Elements with equal keys keep their original order.
+
+    Use:
+        gdb-pipe ... | top <N>; <expr> [; <expr> ...]
+
+    Example:
+        // The 20 largest allocations.
+        gdb-pipe array allocations; num_allocations | top 20; $cur->size
+
+    '''
+    name = 'top'
+    require_input = True
+    tags = ['general']
+    select = staticmethod(heapq.nlargest)
+
+    def __init__(self, limit, cmds):
+        self.limit = limit
+        self.cmds = cmds
+
+    @classmethod
+    def from_userstring(cls, args, first, last):
+        cmd_parts = cls.parse_args(args, [2, float('inf')])
+        limit = int(eval_uint(cmd_parts.pop(0)))
+        return cls(limit, cmd_parts)
+
+    def sort_key(self, element):
+        return tuple(to_native(self.eval_command(element, cmd))
+                     for cmd in self.cmds)
+
+    def describe(self):
+        return '{} {}; {}'.format(self.name, self.limit, '; '.join(self.cmds))
+
+    def iter_def(self, inpipe):
+        yield from self.select(self.limit, inpipe, key=self.sort_key)
+
+
+class Bottom(Top):
+    '''Pass through the `N` elements with the smallest value of an expression.
+
+    Elements come out smallest first, which is what `sort ... | head N` would
+    give, but only the best `N` elements seen so far are held in memory.
+    See `top` for details.
+
+    Use:
+        gdb-pipe ... | bottom <N>; <expr> [; <expr> ...]
+
+    Example:
+        // The 5 arguments first in the alphabet.
+        gdb-pipe follow-until argv; *(char **)$cur == 0; ((char **)$cur) + 1 | \\
+            bottom 5; (*(char **)$cur)[0]
+
+    '''
+    name = 'bottom'
+    select = staticmethod(heapq.nsmallest)
 
 
 class Sort(walkers.Walker):
@@ -557,11 +1004,20 @@ class Sort(walkers.Walker):
 
     For each element, it evaluates the expression given. It then yields the
     elements in their sorted order.
+    Each key is converted to a python int, float, or string once, so sorting
+    doesn't go through GDB's value comparison.
+
+    With `-r` the order is reversed.
+    More than one expression may be given separated by `;`, elements are then
+    sorted by the first, then by the second where the first is equal etc.
+    The sort is stable: elements with equal keys keep their original order.
 
-    Reverse sorting is not supported: negate the expression as a workaround.
+    When more than `walker-sort-memory-limit` elements come in, sorted runs of
+    that many elements are written to temporary files and merged at the end.
+    This is only done for pointer and integer elements.
 
     Use:
-        gdb-pipe ... | sort $cur
+        gdb-pipe ... | sort [-r] <expr> [; <expr> ...]
 
     Example:
         // Sort arguments alphabetically
@@ -572,21 +1028,104 @@ class Sort(walkers.Walker):
     name = 'sort'
     require_input = True
     tags = ['general']
+    spillable_codes = (gdb.TYPE_CODE_PTR, gdb.TYPE_CODE_INT)
 
-    def __init__(self, cmd):
-        self.cmd = cmd
+    def __init__(self, cmds, reverse=False):
+        self.cmds = cmds
+        self.reverse = reverse
+        self.types = {}
 
     @classmethod
     def from_userstring(cls, args, first, last):
-        return cls(args)
+        args = args.strip() if args else ''
+        reverse = args.startswith('-r ') or args == '-r'
+        if reverse:
+            args = args[2:]
+        return cls(cls.parse_args(args, [1, float('inf')]), reverse)
+
+    def fuse(self, following):
+        # Only the first N sorted elements are wanted, a bounded heap finds
+        # them without holding (or spilling) everything.
+        if type(following) is not Head or following.limit < 0:
+            return None
+        selector = Top if self.reverse else Bottom
+        return [selector(following.limit, self.cmds)]
+
+    def sort_key(self, element):
+        return tuple(to_native(self.eval_command(element, cmd))
+                     for cmd in self.cmds)
+
+    def spillable(self, element):
+        return isinstance(element, gdb.Value) and \
+            element.type.strip_typedefs().code in self.spillable_codes
+
+    def spill(self, run):
+        '''Write the sorted `run` to a temporary file and return the file.'''
+        spill_file = tempfile.TemporaryFile()
+        for key, element in run:
+            type_name = str(element.type)
+            self.types.setdefault(type_name, element.type)
+            pickle.dump((key, int(element), type_name), spill_file,
+                        pickle.HIGHEST_PROTOCOL)
+        spill_file.seek(0)
+        return spill_file
+
+    def read_spilled(self, spill_file):
+        with spill_file:
+            while True:
+                try:
+                    key, value, type_name = pickle.load(spill_file)
+                except EOFError:
+                    return
+                yield key, gdb.Value(value).cast(self.types[type_name])
 
     def iter_def(self, inpipe):
-        retlist = sorted(
-            ((self.eval_command(element), element) for element in inpipe),
-            key=operator.itemgetter(0)
-        )
-        for _, element in retlist:
-            yield element
+        limit = gdb.parameter('walker-sort-memory-limit') or 0
+        sort_key = operator.itemgetter(0)
+        run = []
+        spilled = []
+        for element in inpipe:
+            run.append((self.sort_key(element), element))
+            if limit and len(run) >= limit:
+                if not all(self.spillable(element) for _, element in run):
+                    # Can't recreate these elements from a file, keep
+                    # everything in memory.
+                    limit = 0
+                    continue
+                run.sort(key=sort_key, reverse=self.reverse)
+                spilled.append(self.spill(run))
+                run = []
+        run.sort(key=sort_key, reverse=self.reverse)
+        if not spilled:
+            yield from (element for _, element in run)
+            return
+        # heapq.merge() is stable across its inputs, and the runs are given in
+        # the order they were read, so the overall sort is stable.
+        runs = [self.read_spilled(spill_file) for spill_file in spilled]
+        runs.append(iter(run))
+        yield from (element for _, element in
+                    heapq.merge(*runs, key=sort_key, reverse=self.reverse))
+
+
+class WalkerSortMemoryLimit(gdb.Parameter):
+    '''Number of elements `sort` holds in memory before using temporary files.
+
+    0 means never use temporary files.
+
+    '''
+    def __init__(self):
+        super(WalkerSortMemoryLimit, self).__init__(
+            'walker-sort-memory-limit', gdb.COMMAND_DATA, gdb.PARAM_ZUINTEGER)
+        self.value = 1000000
+
+    def get_set_string(self):
+        return self.get_show_string(self.value)
+
+    def get_show_string(self, curval):
+        return 'sort keeps up to {} elements in memory'.format(curval)
+
+
+WalkerSortMemoryLimit()
 
 
 class Dedup(walkers.Walker):
@@ -619,6 +1158,73 @@ class Dedup(walkers.Walker):
             yield element
 
 
+class Uniq(walkers.Walker):
+    '''Remove all elements that have the same value as an earlier one.
+
+    Unlike `dedup` the duplicates don't have to be adjacent.
+    The expression is converted to a python int, float, or string and
+    remembered in a set, so there's no need to `sort` first.
+    The first element with each value is yielded in the order they're seen.
+
+    With `-c` the number of elements with each value is counted, and once the
+    input is exhausted a line with the count and the value is printed for each
+    value, like `sort | uniq -c` in the shell.  If this is not the last
+    command, the first element with each value is then passed on.
+
+    Use:
+        gdb-pipe ... | uniq [-c] <expr>
+
+    Example:
+        // How many times each character starts an argument.
+        gdb-pipe follow-until argv; *(char **)$cur == 0; ((char **)$cur) + 1 | \\
+            uniq -c (*(char **)$cur)[0]
+
+    '''
+    name = 'uniq'
+    require_input = True
+    tags = ['general']
+
+    def __init__(self, cmd, count=False, last=True):
+        self.cmd = cmd
+        self.count = count
+        self.is_last = last
+
+    @classmethod
+    def from_userstring(cls, args, first, last):
+        args = args.strip() if args else ''
+        count = args.startswith('-c ') or args == '-c'
+        if count:
+            args = args[2:].strip()
+        if not args:
+            raise ValueError('uniq requires an expression')
+        return cls(args, count, last)
+
+    def iter_def(self, inpipe):
+        if not self.count:
+            seen = set()
+            for element in inpipe:
+                key = to_native(self.eval_command(element))
+                if key not in seen:
+                    seen.add(key)
+                    yield element
+            return
+
+        # Dictionaries keep insertion order, so the counts come out in the
+        # order each value was first seen.
+        counts = {}
+        for element in inpipe:
+            key = to_native(self.eval_command(element))
+            entry = counts.get(key)
+            if entry is None:
+                counts[key] = [1, element]
+            else:
+                entry[0] += 1
+        for key, (count, _) in counts.items():
+            print('{:>7} {}'.format(count, key))
+        if not self.is_last:
+            yield from (element for _, element in counts.values())
+
+
 class Until(walkers.Walker):
     '''Accept and pass through elements until a condition is broken.
 
@@ -697,6 +1303,7 @@ class Terminated(walkers.Walker):
     '''
     name = 'follow-until'
     tags = ['data']
+    stops_early = True
 
     def __init__(self, start_expr, test_expr, follow_expr):
         self.start_expr = start_expr
@@ -710,8 +1317,13 @@ class Terminated(walkers.Walker):
 
     def follow_to_termination(self, start_ele):
         cur = start_ele
-        while not self.eval_command(cur, self.test_expr):
+        remaining = self.output_limit
+        while remaining != 0 and not self.eval_command(cur, self.test_expr):
             yield cur
+            if remaining is not None:
+                remaining -= 1
+                if remaining == 0:
+                    return
             cur = self.eval_command(cur, self.follow_expr)
 
     def iter_def(self, inpipe):
@@ -746,7 +1358,9 @@ class ForLoop(walkers.Walker):
         cur = start_ele
         while self.eval_command(cur, self.test_expr):
             yield cur
-            self.eval_command(cur, self.follow_expr)
+            # The change expression works through its side-effect on `$cur`,
+            # so it must go through the GDB parser.
+            self.calc(self.format_command(cur, self.follow_expr))
             cur = gdb.convenience_variable('cur')
 
     def iter_def(self, inpipe):
@@ -754,11 +1368,6 @@ class ForLoop(walkers.Walker):
                                   self.follow_to_termination,
                                   self.start_expr)
 
-# TODO
-#   Need to figure out how to handle multiple levels of fetching.
-#   e.g. for gcc-insns, we use
-#      u.fld[0].rt_rtx
-#   This seems like it should be allowed, but it no longer is.
 class LinkedList(walkers.Walker):
     '''Convenience walker for a NULL terminated linked list.
 
@@ -773,6 +1382,12 @@ class LinkedList(walkers.Walker):
     is the equivalent of
         follow-until list_head; $cur == 0; $cur->list_next
 
+    When the next member is made of `->member`, `.member` and `[N]` accesses
+    (e.g. `->u.fld[1].rt_rtx`) and points to the same type as the list head,
+    the list is followed by reading pointers at known offsets directly from
+    inferior memory.
+    Walking stops with a message if the list loops back on itself.
+
     Usage:
         linked-list <list head>; <next member>
         linked-list <next member>
@@ -780,26 +1395,151 @@ class LinkedList(walkers.Walker):
     '''
     name = 'linked-list'
     tags = ['data']
+    member_re = re.compile(r'\s*(?:(->|\.)\s*([A-Za-z_]\w*)|\[\s*(\d+)\s*\])')
 
     def __init__(self, start_expr, next_member):
         self.start_expr = start_expr
+        # A bare member name is taken to mean access through a pointer.
+        if re.match(r'\s*[A-Za-z_]', next_member):
+            next_member = '->' + next_member.strip()
         self.next_member = next_member
+        self.member_path = self.parse_member_path(next_member)
 
     @classmethod
     def from_userstring(cls, args, first, last):
         start_expr, next_member = cls.parse_args(args, [2, 2])
         return cls(start_expr, next_member)
 
-    def __iter_helper(self, element):
+    @classmethod
+    def parse_member_path(cls, next_member):
+        '''Split `next_member` into a list of (accessor, name-or-index).
+
+        Return None if `next_member` is anything other than a chain of
+        `->member`, `.member`, and `[N]` accesses.
+
+        '''
+        path = []
+        pos = 0
+        next_member = next_member.rstrip()
+        while pos < len(next_member):
+            match = cls.member_re.match(next_member, pos)
+            if not match:
+                return None
+            if match.group(3) is not None:
+                path.append(('[', int(match.group(3))))
+            else:
+                path.append((match.group(1), match.group(2)))
+            pos = match.end()
+        if not path or path[0][0] == '[':
+            return None
+        return path
+
+    @staticmethod
+    def find_field(struct_type, name):
+        '''Return (byte offset, gdb.Type) of field `name` in `struct_type`.
+
+        Searches through anonymous members and base classes.
+        Return None if the field can't be found or is a bitfield.
+
+        '''
+        if struct_type.code not in (gdb.TYPE_CODE_STRUCT, gdb.TYPE_CODE_UNION):
+            return None
+        for field in struct_type.fields():
+            if not hasattr(field, 'bitpos') or field.bitsize:
+                continue
+            if field.name == name:
+                return field.bitpos // 8, field.type
+            if field.name is None or field.is_base_class:
+                inner = LinkedList.find_field(field.type.strip_typedefs(), name)
+                if inner is not None:
+                    return field.bitpos // 8 + inner[0], inner[1]
+        return None
+
+    def resolve_offsets(self, pointer_type):
+        '''Turn the next member into offsets from a `pointer_type` value.
+
+        Return a list of byte offsets, where following the list means reading
+        a pointer at (current + offset) for each offset in turn, along with
+        the type of the final pointer.
+        Return (None, None) if this can't be done.
+
+        '''
+        if self.member_path is None:
+            return None, None
+        cur_type = pointer_type
+        offsets = []
+        for accessor, name in self.member_path:
+            stripped = cur_type.strip_typedefs()
+            if accessor == '->' or (not offsets and accessor == '.'):
+                if stripped.code != gdb.TYPE_CODE_PTR:
+                    return None, None
+                offsets.append(0)
+                stripped = stripped.target().strip_typedefs()
+            if accessor == '[':
+                if stripped.code != gdb.TYPE_CODE_ARRAY:
+                    return None, None
+                cur_type = stripped.target()
+                offsets[-1] += name * cur_type.sizeof
+                continue
+            field = self.find_field(stripped, name)
+            if field is None:
+                return None, None
+            offsets[-1] += field[0]
+            cur_type = field[1]
+        if cur_type.strip_typedefs().code != gdb.TYPE_CODE_PTR:
+            return None, None
+        return offsets, cur_type
+
+    @staticmethod
+    def cycle_found(addr):
+        print('linked-list: list loops back to 0x{:x}, stopping'.format(addr))
+
+    def __iter_offsets(self, element, offsets, next_type):
+        inferior = gdb.selected_inferior()
+        pointer_size = next_type.strip_typedefs().sizeof
+        byteorder = target_byteorder()
+        seen = set()
+        cur = element
+        addr = int(element)
+        while addr:
+            if addr in seen:
+                self.cycle_found(addr)
+                return
+            seen.add(addr)
+            yield cur
+            for offset in offsets:
+                addr = int.from_bytes(
+                    inferior.read_memory(addr + offset, pointer_size),
+                    byteorder)
+            cur = gdb.Value(addr).cast(next_type)
+
+    def __iter_expression(self, element):
+        seen = set()
         cur = element
         while cur:
+            addr = int(as_voidptr(cur))
+            if addr in seen:
+                self.cycle_found(addr)
+                return
+            seen.add(addr)
             yield cur
-            # We need to use the `eval_command` method rather than using the
-            # gdb.Value attribute interface to allow the use of syntax such as
-            # `linked-list list_head; direction.next` (i.e. more than one level
-            # deep accesses).
             cur = self.eval_command(cur, '$cur{}'.format(self.next_member))
 
+    @staticmethod
+    def pointee(pointer_type):
+        return pointer_type.strip_typedefs().target().strip_typedefs()
+
+    def __iter_helper(self, element):
+        offsets, next_type = self.resolve_offsets(element.type)
+        # The offsets are only right for every hop if `next` points to the
+        # same type as the start does (e.g. not a list of headers pointing to
+        # nodes, or a start element cast to some other type).
+        if offsets is None \
+                or self.pointee(next_type) != self.pointee(element.type):
+            yield from self.__iter_expression(element)
+        else:
+            yield from self.__iter_offsets(element, offsets, next_type)
+
     def iter_def(self, inpipe):
         yield from self.call_with(inpipe, self.__iter_helper, self.start_expr)
 
@@ -827,6 +1567,9 @@ class Devnull(walkers.Walker):
 class Reverse(walkers.Walker):
     '''Reverse the iteration from the previous command.
 
+    When the previous walker knows its length (e.g. `array`), elements are
+    read from the end rather than all held in memory.
+
     Usage:
         gdb-pipe ... | reverse
 
@@ -842,6 +1585,18 @@ class Reverse(walkers.Walker):
     def from_userstring(cls, args, first, last):
         return cls()
 
+    def fuse(self, following):
+        # The first N of the reversed stream are the last N reversed, and
+        # `tail` only keeps N elements alive.
+        if type(following) is Head and following.limit >= 0:
+            return [Tail(following.limit), Reverse()]
+        return None
+
+    def sequence_def(self, inpipe):
+        if not isinstance(inpipe, walkers.Sequence):
+            return None
+        return inpipe[::-1]
+
     def iter_def(self, inpipe):
         all_elements = list(inpipe)
         all_elements.reverse()
@@ -876,6 +1631,10 @@ class CalledFunctions(walkers.Walker):
         annotated with the function name) then this walker will not pick it
         up.
 
+    If an index has been built with `call-index build`, the call targets of
+    the functions it contains are taken from there rather than from their
+    disassembly.
+
     Usage:
         called-functions <funcname | funcaddr>; <file-regexp>; <maxdepth>; [unique]
 
@@ -931,23 +1690,6 @@ class CalledFunctions(walkers.Walker):
         if addr not in self.hypothetical_stack[::-1]:
             self.func_stack.append((addr, depth))
 
-    @staticmethod
-    def __func_addr(instruction):
-        elements = instruction['asm'].split()
-        # Make sure the format for this instruction is
-        # call... addr <func_name>
-        # Ignore those functions with '@' in them (to avoid @plt functions).
-        #   Note this wouldn't actually matter much because the plt stubs don't
-        #   have any `call` instructions in them. It just saves a little on
-        #   time.
-        # Return the address converted to a number.
-        if re.match('<[^@]*>', elements[-1]) and len(elements) == 3 and \
-                elements[0].startswith('call'):
-            # Just assume it's always hex -- I can't see any way it isn't, but
-            # this assumption makes me a little uneasy.
-            return int(elements[1], base=16)
-        return None
-
     def __iter_helper(self):
         '''
         Iterate over all instructions in a function, put each `call`
@@ -965,13 +1707,20 @@ class CalledFunctions(walkers.Walker):
             if self.maxdepth >= 0 and depth > self.maxdepth:
                 continue
 
-            # If func_dis is None no debugging info was found for this function
+            # If calls is None no debugging info was found for this function
             # and the user required filtering by filename (which we don't know
             # without debugging info) -- hence ignore this.
-            func_dis, _, fname = function_disassembly(func_addr, self.arch,
-                                                      self.dont_fallback)
-            if not func_dis or not re.match(self.file_regexp,
-                                            '' if not fname else fname):
+            index = call_index.current
+            if index is not None and func_addr in index:
+                fname = index.filename(func_addr)
+                calls = index.callees(func_addr)
+                if fname is None and not self.dont_fallback:
+                    calls = None
+            else:
+                fname, calls = call_index.function_calls(
+                    func_addr, self.arch, self.dont_fallback)
+            if calls is None or not re.match(self.file_regexp,
+                                             '' if not fname else fname):
                 continue
 
             # Store the current value in the hypothetical_stack for someone
@@ -981,11 +1730,16 @@ class CalledFunctions(walkers.Walker):
 
             # Go backwards through the list so that we pop off elements in the
             # order they will be called.
-            for val in func_dis[::-1]:
-                new_addr = self.__func_addr(val)
+            for new_addr in reversed(calls):
                 self.__add_addr(new_addr, depth + 1)
 
     def iter_def(self, inpipe):
+        # A prepared pipeline runs the same walker more than once, start each
+        # run afresh.
+        self.func_stack = []
+        self.all_seen = set()
+        type(self).hypothetical_stack = []
+        self.arch = gdb.current_arch()
         if not inpipe:
             self.__add_addr(eval_uint(self.start_expr), 0)
             yield from self.__iter_helper()
@@ -1055,6 +1809,83 @@ class HypotheticalStack(walkers.Walker):
                         self.called_funcs_class.hypothetical_stack)
 
 
+class CallingFunctions(walkers.Walker):
+    '''Walk over all functions that could call the given function.
+
+    Given a function name/address, walk over all functions that directly call
+    it, then all functions that call those etc up to maxdepth (-1 means no
+    limit).  Each function is only given once, nearest callers first.
+    NOTE: The `maxdepth` argument can not use `$cur`.
+
+    It skips all functions defined in a file that doesn't match file-regexp.
+
+    The callers are found from the index built by `call-index build`.
+    If no index has been built, one is built for all functions in files
+    matching file-regexp.  If the index built doesn't cover those functions,
+    this walker builds its own and leaves the current one alone.
+    The given function itself may be anywhere (e.g. in libc).
+
+    NOTE:
+        This has the same limitations as `called-functions`, indirect calls
+        and tail calls are not seen.
+
+    Usage:
+        calling-functions <funcname | funcaddr>; <file-regexp>; <maxdepth>
+
+    '''
+    name = 'calling-functions'
+    tags = ['data']
+
+    def __init__(self, maxdepth, file_regexp, start_expr):
+        self.maxdepth = maxdepth
+        self.file_regexp = file_regexp
+        self.start_expr = start_expr
+        self.private_index = None
+
+    @classmethod
+    def from_userstring(cls, args, first, last):
+        cmd_parts = cls.parse_args(args, [3, 3])
+        return cls(eval_uint(cmd_parts[2]), cmd_parts[1].strip(), cmd_parts[0])
+
+    def index(self):
+        # An index built from other files (e.g. by `call-index build`) would
+        # be missing callers.  Leave the user's index alone and build one
+        # just for this walker in that case.
+        if call_index.current is None:
+            call_index.current = call_index.build(
+                '{}:.*'.format(self.file_regexp))
+        if call_index.current.covers(self.file_regexp):
+            return call_index.current
+        if self.private_index is None:
+            self.private_index = call_index.build(
+                '{}:.*'.format(self.file_regexp))
+        return self.private_index
+
+    def __iter_helper(self, start):
+        index = self.index()
+        start = int(as_voidptr(start))
+        seen = {start}
+        frontier = [start]
+        depth = 0
+        while frontier and (self.maxdepth < 0 or depth < self.maxdepth):
+            depth += 1
+            next_frontier = []
+            for callee in frontier:
+                for caller in index.callers_of(callee):
+                    if caller in seen:
+                        continue
+                    seen.add(caller)
+                    fname = index.filename(caller)
+                    if not re.match(self.file_regexp, fname or ''):
+                        continue
+                    next_frontier.append(caller)
+                    yield as_voidptr(gdb.Value(caller))
+            frontier = next_frontier
+
+    def iter_def(self, inpipe):
+        yield from self.call_with(inpipe, self.__iter_helper, self.start_expr)
+
+
 class File(walkers.Walker):
     '''Walk over numbers read in from a file.
 
@@ -1,7 +1,8 @@
 '''
 Define the framework for creating walkers that can make a pipeline in gdb.
 
-This module adds 4 commands `gdb-pipe` `walker` `walker help` and `walker apropos`.
+This module adds 4 commands `gdb-pipe` `walker` `walker help` and `walker apropos`,
+and the parameter `walker-compile-expressions`.
 
 It also adds the python functions walkers.register_walker() and
 walkers.create_pipeline() that add a walker into the gdb walker namespace and
@@ -15,12 +16,20 @@ import abc
 import gdb
 import os
 import re
+import sys
+import time
+import tracemalloc
 import helpers
 import inspect
+import expressions
 
 # Define the framework
 walkers = {}
 objfile_name = None
+# Toggled by `set walker-plan-pipelines`.
+plan_pipelines = True
+# Pipelines saved with `gdb-pipe prepare`, by name.
+prepared_pipelines = {}
 
 def register_walker(walker_class):
     # Use the manually defined objfile name (defined in 'importer' in
@@ -65,6 +74,55 @@ class WalkerMetaclass(abc.ABCMeta):
         return super().__init__(cls, args, kwargs)
 
 
+class Sequence():
+    '''Elements a walker can count and index without producing them all.
+
+    `element_at(i)` returns element `i` of the `length` elements.
+    If given, `iterate(start, stop)` yields elements start..stop-1 more
+    efficiently than calling `element_at()` for each.
+
+    Slicing returns another Sequence, so walkers like `tail` and `reverse`
+    can pass on a view of their input without reading it.
+
+    '''
+    def __init__(self, length, element_at, iterate=None):
+        self.length = max(0, length)
+        self.element_at = element_at
+        self.iterate = iterate
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        # Walkers check `not inpipe` to find out whether they're first in the
+        # pipeline, an empty sequence is still an input.
+        return True
+
+    def __iter__(self):
+        if self.iterate is not None:
+            return iter(self.iterate(0, self.length))
+        return map(self.element_at, range(self.length))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.view(range(self.length)[index])
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError(index)
+        return self.element_at(index)
+
+    def view(self, indices):
+        '''Return a Sequence of the elements at positions in range `indices`.'''
+        iterate = None
+        if self.iterate is not None and indices.step == 1:
+            iterate = lambda start, stop: self.iterate(indices.start + start,
+                                                       indices.start + stop)
+        return Sequence(len(indices),
+                        lambda index: self.element_at(indices[index]),
+                        iterate)
+
+
 class Walker(metaclass=WalkerMetaclass):
     '''
     Class for a walker type.
@@ -82,12 +140,28 @@ class Walker(metaclass=WalkerMetaclass):
     It is required to return an iterator over python integers.
     These integers usually represent addresses in the program space.
 
+    A walker that knows how many elements it has, and can find any one of
+    them directly, may also implement `sequence_def(self, inpipe)` returning
+    a Sequence.  `connect_pipe()` uses that instead of `iter_def()` when it
+    isn't None, and walkers like `count`, `tail` and `reverse` then avoid
+    reading every element.
+
+    Before a pipeline is connected, the planner (see plan_pipeline()) offers
+    each pair of adjacent walkers to the first one's `fuse()` method, which
+    may return a cheaper list of walkers doing the same thing.  A walker that
+    only reads a bounded number of elements says so in `input_limit()`, and
+    the walker before it is told with `limit_output()`.
+
     '''
     @abc.abstractproperty
     def name(self): pass
     require_input = False
     require_output = False
     tags = []
+    # Walkers that can stop early set `stops_early`, and limit_output() then
+    # records how many elements are needed in `output_limit`.
+    stops_early = False
+    output_limit = None
 
     # n.b. we can't specify the __init__() arguments here, as they can
     # reasonably be different for each walker.
@@ -104,6 +178,46 @@ class Walker(metaclass=WalkerMetaclass):
     def from_userstring(cls, args, first, last):
         pass
 
+    def sequence_def(self, inpipe):
+        '''Return a Sequence of this walker's elements, or None.'''
+        return None
+
+    def fuse(self, following):
+        '''Return walkers that replace this one followed by `following`.
+
+        Return None if there's nothing better than running both in turn.
+
+        '''
+        return None
+
+    def input_limit(self):
+        '''Return the most elements this walker takes from its input.
+
+        None means there is no limit.
+
+        '''
+        return None
+
+    def limit_output(self, limit):
+        '''Note that nothing after the first `limit` elements is needed.
+
+        Walkers with `stops_early` set should produce no more than
+        `output_limit` elements.
+
+        '''
+        if not self.stops_early:
+            return
+        if self.output_limit is None or limit < self.output_limit:
+            self.output_limit = limit
+
+    def describe(self):
+        '''Return the walker as it would be written in a pipeline.'''
+        args = getattr(self, 'userstring', None)
+        text = '{} {}'.format(self.name, args) if args else self.name
+        if self.output_limit is not None:
+            text += '  [stops after {} elements]'.format(self.output_limit)
+        return text
+
     @staticmethod
     def calc(gdb_expr):
         try:
@@ -168,6 +282,23 @@ class Walker(metaclass=WalkerMetaclass):
             raise
         return args
 
+    def compiled_expression(self, args):
+        '''Return the CompiledExpression for template `args`.
+
+        Each template is only compiled once per walker (i.e. once per
+        pipeline), however many elements it is evaluated on.
+
+        '''
+        try:
+            cache = self._compiled_expressions
+        except AttributeError:
+            cache = self._compiled_expressions = {}
+        try:
+            return cache[args]
+        except KeyError:
+            compiled = cache[args] = expressions.CompiledExpression(args)
+            return compiled
+
     def eval_command(self, element, args=None):
         '''Helper method
 
@@ -176,9 +307,15 @@ class Walker(metaclass=WalkerMetaclass):
 
         Otherwise uses `args` instead of `self.cmd`
 
+        Simple templates are evaluated directly on the gdb.Value (see the
+        `expressions` module), in which case `$cur` is not updated.
+
         '''
         args = args if args else self.cmd
-        return self.calc(self.format_command(element, args))
+        try:
+            return self.compiled_expression(args)(element)
+        except expressions.NotLowerable:
+            return self.calc(self.format_command(element, args))
 
     def call_with(self, inpipe, helper, *helper_args):
         if not inpipe:
@@ -221,35 +358,126 @@ def create_walker(walker_def, first=False, last=False):
                          'is not given to it.'.format(walker_name))
     # May raise ValueError if the walker doesn't like the arguments it's
     # been given.
-    return walker.from_userstring(args if args else None, first, last)
-
-
-def connect_pipe(segments):
+    created = walker.from_userstring(args if args else None, first, last)
+    if created is not None:
+        created.userstring = args
+    return created
+
+
+def connect_segment(segment, inpipe):
+    '''Return the Sequence or iterator `segment` gives when fed `inpipe`.'''
+    sequence = segment.sequence_def(inpipe=inpipe)
+    if sequence is not None:
+        return sequence
+    if isinstance(inpipe, Sequence):
+        # Iterating a Sequence starts from the beginning each time, walkers
+        # that don't handle Sequences expect a single iterator they can
+        # partially consume and then continue.
+        inpipe = iter(inpipe)
+    return segment.iter_def(inpipe=inpipe)
+
+
+def connect_pipe(segments, profiler=None, inpipe=None):
     '''
     Each walker in the gdb-pipe is called with the iterator returned by its
     predecessor.
+    If a walker can provide a Sequence (see Walker.sequence_def()), that is
+    passed on instead.
+
+    With a PipelineProfiler, each walker's output is wrapped so the profiler
+    can record the time spent and elements produced.
+
+    `inpipe` is given to the first walker, by default it gets no input.
 
     Return the iterator that the last walker returns.
 
     '''
-    walker = []
+    walker = [] if inpipe is None else inpipe
     for segment in segments:
-        walker = segment.iter_def(inpipe=walker)
+        if profiler is None:
+            walker = connect_segment(segment, walker)
+        else:
+            walker = profiler.connect(segment, walker)
 
     return walker
 
 
-def create_pipeline(arg):
+def plan_pipeline(walker_list):
+    '''Return a list of walkers doing the same as `walker_list`, but cheaper.
+
+    Adjacent walkers are fused (see Walker.fuse()) until no more pairs can be,
+    then limits on how many elements a walker reads are passed to the walker
+    before it (see Walker.input_limit()).
+
+    '''
+    walker_list = list(walker_list)
+    position = 0
+    while position < len(walker_list) - 1:
+        replacement = walker_list[position].fuse(walker_list[position + 1])
+        if replacement is None:
+            position += 1
+            continue
+        walker_list[position:position + 2] = replacement
+        # The new walkers may fuse with the one before them.
+        position = max(0, position - 1)
+    for producer, consumer in zip(walker_list, walker_list[1:]):
+        limit = consumer.input_limit()
+        if limit is not None:
+            producer.limit_output(limit)
+    return walker_list
+
+
+def split_pipeline(arg):
+    '''Split `arg` on the ` | ` between walkers.
+
+    A ` | ` inside braces (a sub-pipeline, see SubPipeline) or inside a
+    string or character literal doesn't separate walkers.  Braces inside
+    literals (e.g. `'{'`) don't count.
+
+    '''
+    # XXX allow escaped ` | ` string (i.e. ` \| ` ).
+    args = []
+    depth = 0
+    quote = None
+    start = 0
+    position = 0
+    while position < len(arg):
+        char = arg[position]
+        if quote is not None:
+            if char == '\\':
+                position += 1
+            elif char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth = max(0, depth - 1)
+        elif depth == 0 and arg.startswith(' | ', position):
+            args.append(arg[start:position])
+            start = position + len(' | ')
+            position = start
+            continue
+        position += 1
+    args.append(arg[start:])
+    return args
+
+
+def parse_pipeline(arg, nested=False):
     '''
     Split our arguments into walker definitions.
     Instantiate the walkers with these definitions.
-    Join the walkers together.
 
-    Return the iterator over all walkers.
+    With `nested`, every walker is told it has input and output, as in a
+    SubPipeline.
+
+    Return the list of walkers.
 
     '''
-    # XXX allow escaped ` | ` string (i.e. ` \| ` ).
-    args = arg.split(' | ')
+    args = split_pipeline(arg)
+    if nested:
+        return [create_walker(val) for val in args if val.strip()]
     # Create the first walker with an argument that tells it it's going to
     # be the first.
     only_one = len(args) == 1
@@ -257,8 +485,373 @@ def create_pipeline(arg):
     walker_list.extend([create_walker(val) for val in args[1:-1] if val])
     if not only_one:
         walker_list.append(create_walker(args[-1], first=False, last=True))
+    return walker_list
+
+
+def create_pipeline(arg, profiler=None):
+    '''
+    Create the walkers described in `arg`, plan them (unless
+    `walker-plan-pipelines` is off) and join the walkers together.
+
+    Return the iterator over all walkers.
+
+    '''
+    walker_list = parse_pipeline(arg)
+    if plan_pipelines:
+        walker_list = plan_pipeline(walker_list)
+    return connect_pipe(walker_list, profiler)
+
+
+class SubPipeline():
+    '''A pipeline written in braces as the argument of a walker.
+
+    e.g. the `{ linked-list $cur->children; next | if $cur->x == 0 }` of
+        gdb-pipe ... | exists { linked-list $cur->children; next | if ... }
+
+    The walkers are created once, and run for each element the enclosing
+    walker sees with that element as their only input.  The enclosing
+    pipeline's `$cur` is put back once each run is over.
+
+    '''
+    def __init__(self, text):
+        text = text.strip() if text else ''
+        if not (text.startswith('{') and text.endswith('}')):
+            raise ValueError('Expected a pipeline in braces, e.g. '
+                             '"{{ if $cur != 0 }}", got "{}"'.format(text))
+        self.text = text[1:-1].strip()
+        if not self.text:
+            raise ValueError('Empty sub-pipeline')
+        walker_list = parse_pipeline(self.text, nested=True)
+        if plan_pipelines:
+            walker_list = plan_pipeline(walker_list)
+        self.walkers = walker_list
+
+    def __run(self, element, consume):
+        saved = gdb.convenience_variable('cur')
+        try:
+            # An iterator rather than a list, walkers may continue an input
+            # they have partially consumed.
+            pipeline_end = connect_pipe(self.walkers, inpipe=iter([element]))
+            return consume(pipeline_end)
+        finally:
+            gdb.set_convenience_variable('cur', saved)
+
+    def any(self, element):
+        '''Return whether the sub-pipeline gives anything for `element`.
+
+        Stops at the first element the sub-pipeline gives.
+
+        '''
+        def consume(pipeline_end):
+            for _ in pipeline_end or ():
+                return True
+            return False
+        return self.__run(element, consume)
+
+    def count(self, element):
+        '''Return how many elements the sub-pipeline gives for `element`.'''
+        def consume(pipeline_end):
+            if isinstance(pipeline_end, Sequence):
+                return len(pipeline_end)
+            return sum(1 for _ in pipeline_end or ())
+        return self.__run(element, consume)
+
+
+class PreparedPipeline():
+    '''A pipeline parsed and planned once, to be run many times.
+
+    Splitting the text, looking up walkers, and calling their
+    `from_userstring()` is done here once.  Each run only creates new
+    iterators from the same walkers.
+    Arguments a walker evaluates when it's created (e.g. the `N` of `head N`)
+    are hence evaluated once, when the pipeline is prepared.
+
+    Iterating over a PreparedPipeline runs it, e.g. from a
+    gdb.Breakpoint.stop() method:
+        pipeline = walkers.prepare_pipeline('array argv; argc | count')
+        for element in pipeline:
+            ...
+
+    '''
+    def __init__(self, text):
+        self.text = text
+        walker_list = parse_pipeline(text)
+        if plan_pipelines:
+            walker_list = plan_pipeline(walker_list)
+        self.walkers = walker_list
+
+    def connect(self, profiler=None):
+        '''Return the end of a new run, as create_pipeline() would.'''
+        return connect_pipe(self.walkers, profiler)
+
+    def __iter__(self):
+        pipeline_end = self.connect()
+        return iter(pipeline_end if pipeline_end is not None else ())
+
+    def run(self, addresses=False, fd=None):
+        '''Run the pipeline, printing its elements as `gdb-pipe run` does.'''
+        pipeline_end = self.connect()
+        if pipeline_end is not None:
+            output_pipeline(pipeline_end, addresses, fd)
+
 
-    return connect_pipe(walker_list)
+def prepare_pipeline(text, name=None):
+    '''Return a PreparedPipeline for `text`.
+
+    If `name` is given, also save it for `gdb-pipe run NAME`.
+
+    '''
+    prepared = PreparedPipeline(text)
+    if name is not None:
+        prepared_pipelines[name] = prepared
+    return prepared
+
+
+def run_prepared(name, addresses=False, fd=None):
+    '''Run the pipeline saved as `name`, printing its elements.'''
+    try:
+        prepared = prepared_pipelines[name]
+    except KeyError:
+        raise ValueError('No prepared pipeline named "{}"'.format(name))
+    prepared.run(addresses, fd)
+
+
+def parse_pipe_options(arg):
+    '''Split leading `--option` words off the `gdb-pipe` command line.
+
+    Return a dictionary of the options given (`--name=value` maps `name` to
+    `value`, `--name` maps `name` to True) and the remaining text.
+
+    '''
+    options = {}
+    arg = arg.lstrip()
+    while arg.startswith('--'):
+        word, _, arg = arg.partition(' ')
+        name, equals, value = word[2:].partition('=')
+        options[name] = value if equals else True
+        arg = arg.lstrip()
+    return options, arg
+
+
+def benchmark_pipeline(pipeline_end, memory=False):
+    '''Consume `pipeline_end` without printing and report how long it took.
+
+    With `memory`, also report the peak memory python allocated meanwhile.
+
+    '''
+    expressions.stats.clear()
+    if memory:
+        tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        count = 0
+        for count, _ in enumerate(pipeline_end, start=1):
+            pass
+        elapsed = time.perf_counter() - start
+        if memory:
+            _, peak = tracemalloc.get_traced_memory()
+    finally:
+        if memory:
+            tracemalloc.stop()
+    print('{} elements in {:.3f}s'.format(count, elapsed))
+    if memory:
+        print('Peak python memory: {} KiB'.format(peak // 1024))
+    print('Expressions evaluated directly: {}, through GDB parser: {}'.format(
+        expressions.stats['lowered'], expressions.stats['parsed']))
+
+
+class StageProfile():
+    '''What one walker did in a pipeline run under `gdb-pipe --profile`.'''
+    __slots__ = ('name', 'elements_out', 'time', 'parse_and_eval', 'execute')
+
+    def __init__(self, name):
+        self.name = name
+        self.elements_out = 0
+        self.time = 0.0
+        self.parse_and_eval = 0
+        self.execute = 0
+
+
+class PipelineProfiler():
+    '''Time each stage of a pipeline and count the GDB calls it makes.
+
+    Each walker's output is wrapped so that the time spent getting every
+    element from it is recorded against that walker.  This time includes
+    getting elements from the walkers before it, the difference is the time
+    spent in the walker itself.
+
+    While used as a context manager, gdb.parse_and_eval() and gdb.execute()
+    are replaced by versions that count calls against the walker currently
+    producing an element.
+
+    '''
+    def __init__(self):
+        self.stages = []
+        self.active = []
+        self.originals = {}
+
+    def __enter__(self):
+        for name in ('parse_and_eval', 'execute'):
+            original = self.originals[name] = getattr(gdb, name)
+            setattr(gdb, name, self.counting(name, original))
+        return self
+
+    def __exit__(self, *_):
+        for name, original in self.originals.items():
+            setattr(gdb, name, original)
+        self.originals = {}
+
+    def counting(self, name, function):
+        def counted(*args, **kwargs):
+            if self.active:
+                stage = self.active[-1]
+                setattr(stage, name, getattr(stage, name) + 1)
+            return function(*args, **kwargs)
+        return counted
+
+    def timed_call(self, stage, function, *args):
+        self.active.append(stage)
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            stage.time += time.perf_counter() - start
+            self.active.pop()
+
+    def timed_iter(self, stage, iterator):
+        iterator = iter(iterator)
+        while True:
+            try:
+                element = self.timed_call(stage, next, iterator)
+            except StopIteration:
+                return
+            stage.elements_out += 1
+            yield element
+
+    def timed_element(self, stage, element_at, index):
+        element = self.timed_call(stage, element_at, index)
+        stage.elements_out += 1
+        return element
+
+    def connect(self, segment, inpipe):
+        '''Connect `segment` to `inpipe` as connect_segment(), but profiled.'''
+        stage = StageProfile(segment.name)
+        self.stages.append(stage)
+        # Walkers that consume their input straight away (like `devnull`) do
+        # all their work here.
+        outpipe = self.timed_call(stage, connect_segment, segment, inpipe)
+        if isinstance(outpipe, Sequence):
+            iterate = outpipe.iterate
+            return Sequence(
+                len(outpipe),
+                lambda index: self.timed_element(stage, outpipe.element_at,
+                                                 index),
+                None if iterate is None else
+                lambda start, stop: self.timed_iter(stage,
+                                                    iterate(start, stop)))
+        if outpipe is None:
+            return None
+        return self.timed_iter(stage, outpipe)
+
+    def report(self):
+        row = '{:>5}  {:<20} {:>10} {:>10} {:>10} {:>10} {:>8} {:>8}'
+        print(row.format('stage', 'walker', 'in', 'out', 'total(s)', 'self(s)',
+                         'parse', 'execute'))
+        upstream = None
+        for position, stage in enumerate(self.stages, start=1):
+            upstream_time = upstream.time if upstream else 0.0
+            print(row.format(
+                position, stage.name,
+                upstream.elements_out if upstream else '-',
+                stage.elements_out,
+                '{:.4f}'.format(stage.time),
+                '{:.4f}'.format(max(0.0, stage.time - upstream_time)),
+                stage.parse_and_eval, stage.execute))
+            upstream = stage
+
+
+def render_element(element, addresses=False):
+    '''Return the text `output $cur` would print for `element`.
+
+    Integers are formatted in python, everything else is formatted by the
+    gdb.Value itself, which avoids dispatching any gdb commands.
+    Pointers and references get the `(type) ` prefix `output` gives them
+    (except plain `char *`, which `output` shows as a string).
+    With `addresses`, every element is printed as a bare hex number.
+
+    '''
+    if not isinstance(element, gdb.Value):
+        return hex(element) if addresses else str(element)
+    if addresses:
+        return hex(int(element) & 0xffffffffffffffff)
+    element_type = element.type.strip_typedefs()
+    # Single byte integers are printed as characters by gdb.
+    if element_type.code == gdb.TYPE_CODE_INT and element_type.sizeof > 1:
+        return str(int(element))
+    if element_type.code in (gdb.TYPE_CODE_PTR, gdb.TYPE_CODE_REF):
+        # Mirrors c_value_print(), which leaves the type off unnamed
+        # pointers to `char`.
+        if element.type.name is not None \
+                or element.type.target().name != 'char':
+            return '({}) {}'.format(element.type, element)
+    return str(element)
+
+
+class OutputBuffer():
+    '''Collect lines of text and write them out in large chunks.
+
+    Text goes through gdb.write() (and hence the pager) unless a file
+    descriptor is given, in which case it's written to that directly.
+
+    Used as a context manager without a file descriptor, it stands in for
+    sys.stdout, so whatever walkers print goes into the buffer in order with
+    the elements.  Walkers writing through GDB itself (e.g. `show`) must call
+    sys.stdout.flush() first.
+
+    '''
+    chunk_size = 1 << 16
+
+    def __init__(self, fd=None):
+        self.fd = fd
+        self.pending = []
+        self.pending_size = 0
+
+    def write(self, text):
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.pending_size >= self.chunk_size:
+            self.flush()
+
+    def __enter__(self):
+        self.stdout = None
+        if self.fd is None:
+            self.stdout, sys.stdout = sys.stdout, self
+        return self
+
+    def __exit__(self, *_):
+        if self.stdout is not None:
+            sys.stdout = self.stdout
+        self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        text = ''.join(self.pending)
+        self.pending = []
+        self.pending_size = 0
+        if self.fd is None:
+            gdb.write(text)
+            return
+        data = text.encode()
+        while data:
+            data = data[os.write(self.fd, data):]
+
+
+def output_pipeline(pipeline_end, addresses=False, fd=None):
+    '''Print every element coming out of `pipeline_end`, one per line.'''
+    with OutputBuffer(fd) as output:
+        for element in pipeline_end:
+            output.write(render_element(element, addresses) + '\n')
 
 
 class Pipeline(gdb.Command):
@@ -267,7 +860,37 @@ class Pipeline(gdb.Command):
     `gdb-pipe` command to string multiple commands together.
 
     Usage:
-        gdb-pipe walker1 | walker2 | walker3 ...
+        gdb-pipe [--benchmark[=memory]] [--profile] [--addresses] [--fd=N] \\
+            walker1 | ...
+
+    With `--addresses`, each element is printed as a bare hex number instead
+    of how `output` would show it.
+    With `--fd=N`, output is written directly to file descriptor N rather
+    than through the GDB pager.
+
+    With `--benchmark`, the pipeline is run without printing its output, and
+    the time taken is printed instead.  Running the same pipeline with
+    `set walker-compile-expressions off` shows how much time is saved by
+    evaluating simple expressions directly.
+    `--benchmark=memory` also prints the peak memory allocated by python
+    while the pipeline ran (this makes the pipeline itself slower).
+
+    With `--profile`, a table is printed after the pipeline finishes showing
+    for each walker the elements it was given and produced, the time spent
+    getting its elements (total, and excluding walkers before it), and how
+    many `gdb.parse_and_eval` and `gdb.execute` calls it made.
+
+    A pipeline that's run many times (e.g. in breakpoint `commands`) can be
+    parsed once with
+        gdb-pipe prepare NAME walker1 | ...
+    and then run with
+        gdb-pipe [options] run NAME
+    (options are only accepted by `run`).
+    `gdb-pipe run` without a name lists the prepared pipelines.
+    Arguments walkers evaluate when they're created (e.g. `head N`) are
+    evaluated when the pipeline is prepared.
+    From python, walkers.prepare_pipeline() returns a PreparedPipeline that
+    runs each time it's iterated over.
 
     Use:
         (gdb) walker help walkers
@@ -286,19 +909,65 @@ class Pipeline(gdb.Command):
         create the pipeline according to 'arg'.
 
         Iterate over all elements coming out the end of the gdb-pipe, printing them
-        out as a hex value to screen.
+        out to screen in batches.
 
         '''
-        pipeline_end = create_pipeline(arg)
+        options, arg = parse_pipe_options(arg)
+        unknown = set(options) - {'benchmark', 'profile', 'addresses', 'fd'}
+        if unknown:
+            raise ValueError('Unknown gdb-pipe option(s): {}'.format(
+                ', '.join(sorted(unknown))))
+        fd = options.get('fd')
+        if fd is not None:
+            if fd is True or not fd.isdigit():
+                raise ValueError('gdb-pipe --fd requires a file descriptor number')
+            fd = int(fd)
+        benchmark = options.get('benchmark')
+        if benchmark and benchmark not in (True, 'memory'):
+            raise ValueError('gdb-pipe --benchmark only accepts "memory"')
+
+        subcommand, _, rest = arg.strip().partition(' ')
+        if subcommand == 'prepare':
+            name, _, text = rest.strip().partition(' ')
+            if not name or not text.strip():
+                raise ValueError('Usage: gdb-pipe prepare NAME walker1 | ...')
+            if options:
+                raise ValueError('gdb-pipe options are given with '
+                                 '`gdb-pipe [options] run NAME`, not prepare')
+            prepare_pipeline(text, name)
+            return
+        if subcommand == 'run':
+            name = rest.strip()
+            if not name:
+                for name, prepared in sorted(prepared_pipelines.items()):
+                    print('{}: {}'.format(name, prepared.text))
+                return
+            if name not in prepared_pipelines:
+                raise ValueError('No prepared pipeline named "{}"'.format(name))
+            connect = prepared_pipelines[name].connect
+        else:
+            connect = lambda profiler=None: create_pipeline(arg, profiler)
+
+        if options.get('profile'):
+            with PipelineProfiler() as profiler:
+                self.run(connect(profiler), options, fd)
+            profiler.report()
+            return
+
+        self.run(connect(), options, fd)
 
+    @staticmethod
+    def run(pipeline_end, options, fd):
         # element should be an integer
         if pipeline_end is None:
             return
 
-        for element in pipeline_end:
-            gdb.set_convenience_variable('cur', element)
-            gdb.execute('output $cur')
-            gdb.execute('echo \\n')
+        benchmark = options.get('benchmark')
+        if benchmark:
+            benchmark_pipeline(pipeline_end, benchmark == 'memory')
+            return
+
+        output_pipeline(pipeline_end, bool(options.get('addresses')), fd)
 
     def complete(self, _, word):
         if not word:
@@ -306,6 +975,52 @@ class Pipeline(gdb.Command):
         return [key for key in walkers if key.startswith(word)]
 
 
+class WalkerCompileExpressions(gdb.Parameter):
+    '''Should walkers evaluate simple expressions without the GDB parser.
+
+    Boolean - true => expressions like `$cur->field` and `$cur + 1` are
+                      evaluated directly on the current value.
+              false => every expression goes through GDB's parser.
+
+    '''
+    def __init__(self):
+        super(WalkerCompileExpressions, self).__init__(
+            'walker-compile-expressions', gdb.COMMAND_DATA, gdb.PARAM_BOOLEAN)
+        self.value = True
+
+    def get_set_string(self):
+        expressions.enabled = self.value
+        return 'walker expressions will {}be evaluated directly'.format(
+            '' if self.value else 'not ')
+
+    def get_show_string(self, curval):
+        return curval + ': ' + self.get_set_string()
+
+
+class WalkerPlanPipelines(gdb.Parameter):
+    '''Should pipelines be rewritten into cheaper equivalents before running.
+
+    Boolean - true => e.g. `sort ... | head N` runs as `bottom N; ...`.
+              false => walkers are run exactly as written.
+
+    Use `walker explain` to see what a pipeline is rewritten to.
+
+    '''
+    def __init__(self):
+        super(WalkerPlanPipelines, self).__init__(
+            'walker-plan-pipelines', gdb.COMMAND_DATA, gdb.PARAM_BOOLEAN)
+        self.value = True
+
+    def get_set_string(self):
+        global plan_pipelines
+        plan_pipelines = self.value
+        return 'pipelines will {}be rewritten before running'.format(
+            '' if self.value else 'not ')
+
+    def get_show_string(self, curval):
+        return curval + ': ' + self.get_set_string()
+
+
 class WalkerCommand(gdb.Command):
     '''Prefix command for walker introspection commands.'''
     def __init__(self):
@@ -435,7 +1150,39 @@ class WalkerApropos(gdb.Command):
                 print(name, '--', walker.__doc__.split('\n', 1)[0])
 
 
+class WalkerExplain(gdb.Command):
+    '''Show how a pipeline would be run.
+
+    Prints the walkers as written, then the plan that `gdb-pipe` runs after
+    adjacent walkers are fused and limits are pushed into earlier walkers.
+    The pipeline is not run.
+
+    Usage:
+        walker explain walker1 | walker2 ...
+
+    '''
+    def __init__(self):
+        super(WalkerExplain, self).__init__('walker explain',
+                                            gdb.COMMAND_SUPPORT)
+
+    def invoke(self, arg, _):
+        _, arg = parse_pipe_options(arg)
+        walker_list = parse_pipeline(arg)
+        print('Written:')
+        for position, walker in enumerate(walker_list, start=1):
+            print('  {:>2}  {}'.format(position, walker.describe()))
+        if not plan_pipelines:
+            print('Plan: as written (walker-plan-pipelines is off)')
+            return
+        print('Plan:')
+        for position, walker in enumerate(plan_pipeline(walker_list), start=1):
+            print('  {:>2}  {}'.format(position, walker.describe()))
+
+
 Pipeline()
+WalkerCompileExpressions()
+WalkerPlanPipelines()
 WalkerCommand()
 WalkerHelp()
 WalkerApropos()
+WalkerExplain()